@@ -18,7 +18,7 @@ try:
         license='MIT',
         packages=['sack'],
         install_requires=[
-            'pandas'
+            'pandas>=1.5'
         ],
         package_data={
 			'py_base': ['config/*.json']
@@ -7,20 +7,180 @@
 #       You will have, after creating the object and parsing, a python dictionary will all your credentials.
 # Changelog
 #       * 9/1/20 - Created. 
+#       * JsonConfigParser caches what it parsed for the life of the process, until the file changes.
+#       * JsonConfigParser skips straight to the sub_keys it needs in big files instead of loading all of it.
+#       * EnvConfigParser checks plain prefixes without regex, or in a sorted snapshot of the environment with indexed=True.
+#       * DSNs are built from the DSN_SCHEMAS table, and only rebuilt when a key they use changes.
+#       * Log files are written from a background thread through a queue, the backlog is bounded and filtered.
+#       * ConfigWatcher reloads a config when it's source changes and tells you which keys changed.
+#       * LayeredConfigParser stacks defaults, environment files, env vars and overrides into one config.
+#       * freeze/FrozenConfig write a parsed config to a compact file every worker process can map and share.
 # Frantic Scribbling on the Wall
 # The magical issue of 'I want a logger, but to get a logger I need to use the parser to get the log_path'
 #       I fixed that bitch with a backlog and dynamic log method BOOM
 # TODO: Shift "PrePath Logging" into a stand alone, implement in logger. Basically a wrapper around a real logger?
 
 import os
+import atexit
+import bisect
+import collections
 import json
+import marshal
+import mmap
+import queue
+import stat
+import struct
+import tempfile
+import threading
+import types
 # from py_base import py_base_log as logging
 # import py_base_log as logging
 import logging
+import logging.handlers
 import re
+from collections.abc import Mapping
+
+# ConfigParser.log's level names, and what they are to the logging module.
+LOG_LEVELS = {
+    'debug': logging.DEBUG, 'info': logging.INFO, 'warn': logging.WARNING, 'warning': logging.WARNING,
+    'error': logging.ERROR, 'exception': logging.ERROR,
+}
+# Logger method each level is logged with, the custom py_base loggers only promise these.
+LOG_METHODS = {'debug': 'debug', 'info': 'info', 'warn': 'warning', 'warning': 'warning', 'error': 'error', 'exception': 'exception'}
+
+class DirectoryFileHandler(logging.FileHandler):
+    """
+    A FileHandler that makes the directory it's log file goes in, if it needs to. Used with delay=True, the
+    directory and file aren't touched until the first record is written, which happens on the 
+    QueueListener's thread, so whoever logged never waits on the disk.
+    """
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+# log file path -> logger feeding that file through a queue. One per file for the whole process.
+_queue_loggers = {}
+_queue_loggers_lock = threading.Lock()
+# log file path -> the QueueListener writing that file, in this process.
+_queue_listeners = {}
+
+def queue_logger(log_path):
+    """
+    The logger for ConfigParser logs under the log_path directory, shared by every parser using it. Logging
+    to it only puts the record on a queue; a QueueListener thread takes them off and does the actual file 
+    writing. Whatever is still queued is written out when the interpreter exits.
+    """
+    path = os.path.abspath(os.path.join(log_path, 'ConfigParser.basic.log'))
+    with _queue_loggers_lock:
+        logger = _queue_loggers.get(path)
+        if logger is None:
+            logger = logging.getLogger(f'ConfigParser.{path}')
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            _listen(path, logger)
+            _queue_loggers[path] = logger
+    return logger
+
+def _listen(path, logger):
+    """Gives logger a fresh queue, and a QueueListener thread in this process writing it to path."""
+    handler = DirectoryFileHandler(path, delay=True)
+    # Same lines logging.basicConfig wrote on the root logger, before the writing moved to a queue.
+    handler.setFormatter(logging.Formatter('%(levelname)s:root:%(message)s'))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    _queue_listeners[path] = listener
+
+@atexit.register
+def _stop_listeners():
+    for listener in list(_queue_listeners.values()):
+        listener.stop()
+
+def _after_fork():
+    """
+    A forked child gets the parent's loggers but not the listener threads behind them, so anything it 
+    logged would sit on the queue forever. Every logger gets a queue and listener of the child's own, 
+    parsers already holding one keep working, and what the parent had queued is left for the parent.
+    """
+    global _queue_loggers_lock
+    _queue_loggers_lock = threading.Lock()
+    _queue_listeners.clear()
+    for path, logger in _queue_loggers.items():
+        _listen(path, logger)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+# One piece of a DSN: template has the key's value formatted into it. With optional, the piece is left out
+# unless the key has a value. With a default, the default stands in for an empty value. Otherwise it's the 
+# value, or the parser's elseget when the key isn't there at all.
+DsnPart = collections.namedtuple('DsnPart', ['template', 'key', 'default', 'optional'], defaults=[None, False])
+
+_SSL_PARTS = (
+    DsnPart(';PROTOCOL={}', 'protocol', optional=True),
+    DsnPart(';SECURITY={}', 'security', optional=True),
+    DsnPart(';SSLSERVERCERTIFICATE={}', 'sslcertificate', optional=True),
+    DsnPart(';SSLCLIENTKEYSTOREDB={}', 'sslclientkeystore', optional=True),
+    DsnPart(';SSLCLIENTKEYSTASH={}', 'sslclientstash', optional=True),
+)
+
+# Every kind of DSN ConfigParser.validate can build. output is the key the DSN is stored under, the
+# required keys have to be there (or validate raises), missing optional keys are logged at optional_level.
+# A new dialect is a new entry here, not new code.
+DSN_SCHEMAS = {
+    'db2': {
+        'output': 'db2dsn',
+        'label': 'DB2',
+        'required': ("database", "host", "username", "password", "port"),
+        'optional': ("dialect", "driver", "protocol", "security", "sslcertificate", "sslclientkeystore", "sslclientstash"),
+        'optional_level': 'warn',
+        'parts': (
+            DsnPart('Driver={}', 'driver', default='{IBM DB2 ODBC Driver}'),
+            DsnPart(';DATABASE={}', 'database'),
+            DsnPart(';HOSTNAME={}', 'host'),
+            DsnPart(';PORT={}', 'port'),
+            DsnPart(';UID={}', 'username'),
+            DsnPart(';PWD={}', 'password'),
+        ) + _SSL_PARTS,
+    },
+    'database': {
+        'output': 'dsn',
+        'label': 'the database',
+        'required': ("dialect", "database", "host", "username", "password", "port"),
+        'optional': ("driver", "protocol", "security", "sslcertificate", "sslclientkeystore", "sslclientstash"),
+        'optional_level': 'debug',
+        'parts': (
+            DsnPart('{}', 'dialect', default='db2'),
+            DsnPart('{}', 'driver'),
+            DsnPart('://{}', 'username'),
+            DsnPart(':{}', 'password'),
+            DsnPart('@{}', 'host'),
+            DsnPart(':{}', 'port'),
+            DsnPart('/{}', 'database'),
+        ) + _SSL_PARTS,
+    },
+}
+
+# Stands in for a key that isn't there when comparing values, since None is a value a key can have.
+_MISSING = object()
 
 class ConfigParser(dict):
     
+    # Messages below log_level are dropped by log before anything is done with them. Messages logged 
+    # before there's a log file are printed if they're at least console_level. Set either on a parser
+    # to change it for just that parser. 
+    log_level = logging.INFO
+    console_level = logging.INFO
+    # Most messages held waiting for a log file, the oldest are dropped first.
+    backlog_size = 1000
+    
+    # A new token every time the contents change, see _changed. A class default so it's there even 
+    # for items set before __init__ runs (unpickling does that).
+    _version = None
+    
     def __init__(self, clean=True):
         """ An extension of the python dictionary class with methods to load and validate data loaded 
         from different sources. This is the base class for each different data source, called ConfigParser. 
@@ -34,14 +194,60 @@ class ConfigParser(dict):
         log is created. Logging can either use the base logging configuration, or py_base's custom logger. Which is
         imported is detected when the log file is created. All things logged before the logpath is loaded and therefore,
         the log file can be created, are logged when the log file is made. Additionally, console logging will take place
-        before a log file is created for debugging purposes. 
+        before a log file is created for debugging purposes. The backlog only keeps the last backlog_size messages.
         
         elseget is used by the validation functions; it represents the value to place into the dsn's if the value is not found.
         """
         self.clean = clean
         self.logger = None
-        self.backlog = []
+        self.backlog = collections.deque(maxlen=self.backlog_size)
         self.elseget = ''
+        # schema name -> (version, values used, DSN) for the last DSN built, see dsn.
+        self._dsns = {}
+    
+    # Every way a dict can be changed goes through _changed, so _version always tells whether anything 
+    # might be different since the last time it was looked at. Each version is a new object rather than
+    # a count: a copy.copy shares _dsns with the original, and two parsers counting on their own could 
+    # land on the same number with different contents. An object is only ever the same as itself, copies
+    # and unpickled parsers included.
+    def _changed(self):
+        self._version = object()
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+    
+    def __ior__(self, other):
+        dict.update(self, other)
+        self._changed()
+        return self
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+    
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._changed()
+        return dict.setdefault(self, key, default)
+    
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._changed()
+        return value
+    
+    def popitem(self):
+        item = dict.popitem(self)
+        self._changed()
+        return item
+    
+    def clear(self):
+        dict.clear(self)
+        self._changed()
         
     def parse(self):
         """ Primary method to be defined in Implementations. Loads the data from a data source into this object.
@@ -81,41 +287,9 @@ class ConfigParser(dict):
         of a valid DSN for a DB2 connection. Expects particular names in the source data, so 
         one should fill in the blanks in one of the sample_credentials files in the instance folder
         rather than create their own config. A DSN can be formed without this, but this standardizes
-        the configuration file as well as the code. 
+        the configuration file as well as the code. See validate.
         """
-        required = set(["database", "host", "username", "password", "port"])
-        optional = set(["dialect", "driver", "protocol", "security", "sslcertificate", "sslclientkeystore", "sslclientstash"])
-        
-        keys = set(self.keys())
-        # Check if all the required keys are found in the loaded parse. 
-        # (Uses subset notation, required is subset of self.keys())
-        # Also viable, required - set is empty
-        if not required <= keys:
-            self.log(f"Required keys {required - keys} not found, will not be able to connect to DB2.", "error")
-            raise Exception(f"Required keys {required - keys} not found, will not be able to connect to DB2.")
-        if not optional <= keys:
-            self.log(f"Optional keys {optional - keys} not found.", "warn")
-        
-        dsn = f"Driver={self.get('driver', self.elseget)if self.get('driver') else '{IBM DB2 ODBC Driver}'}"
-        dsn += f";DATABASE={self.get('database', self.elseget)}"
-        dsn += f";HOSTNAME={self.get('host', self.elseget)}"
-        dsn += f";PORT={self.get('port', self.elseget)}"
-        dsn += f";UID={self.get('username', self.elseget)}"
-        dsn += f";PWD={self.get('password', self.elseget)}"
-        if self.get('protocol'):
-            dsn += f";PROTOCOL={self.get('protocol', self.elseget)}"
-        if self.get('security'):
-            dsn += f";SECURITY={self.get('security', self.elseget)}" 
-        if self.get('sslcertificate'):
-            dsn += f";SSLSERVERCERTIFICATE={self.get('sslcertificate', self.elseget)}" 
-        if self.get('sslclientkeystore'):
-            dsn += f";SSLCLIENTKEYSTOREDB={self.get('sslclientkeystore', self.elseget)}" 
-        if self.get('sslclientstash'):
-            dsn += f";SSLCLIENTKEYSTASH={self.get('sslclientstash', self.elseget)}"
-        
-        self['db2dsn'] = dsn
-
-        return self
+        return self.validate('db2')
     
     def validate_database(self):
         """
@@ -123,42 +297,119 @@ class ConfigParser(dict):
         of a valid DSN for a Database connection. Expects particular names in the source data, so 
         one should fill in the blanks in one of the sample_credentials files in the instance folder
         rather than create their own config. A DSN can be formed without this, but this standardizes
-        the configuration file as well as the code. 
+        the configuration file as well as the code. See validate.
+        """
+        return self.validate('database')
+    
+    def validate(self, schema):
+        """
+        Checks this object has what the DSN_SCHEMAS entry named schema needs, then builds the DSN and stores
+        it under the schema's output key ('db2dsn', 'dsn'). Missing required keys raise, missing optional 
+        ones are logged. 
+        
+        Nothing is checked or built again while the values the DSN is made of stay the same, see dsn.
+        """
+        dsn = self.dsn(schema)
+        output = DSN_SCHEMAS[schema]['output']
+        if self.get(output) != dsn:
+            self[output] = dsn
+            self._dsns[schema] = (self._version,) + self._dsns[schema][1:]
+        return self
+    
+    def dsn(self, schema):
+        """
+        Returns the DSN for the DSN_SCHEMAS entry named schema, without storing it. The DSN is cached: if 
+        nothing in this object changed since it was built, it's handed straight back, and if something 
+        did but none of the keys the DSN uses (or elseget) changed, it still isn't rebuilt.
         """
-        required = set(["dialect", "database", "host", "username", "password", "port"])
-        optional = set(["driver", "protocol", "security", "sslcertificate", "sslclientkeystore", "sslclientstash"])
+        if schema not in DSN_SCHEMAS:
+            self.log(f"No DSN schema named {schema}, pick from {sorted(DSN_SCHEMAS)}.", "error")
+            raise Exception(f"No DSN schema named {schema}, pick from {sorted(DSN_SCHEMAS)}.")
+        cached = self._dsns.get(schema)
+        if cached is not None and cached[0] is self._version:
+            return cached[2]
+        
+        definition = DSN_SCHEMAS[schema]
+        used = definition['required'] + definition['optional'] + tuple(part.key for part in definition['parts'])
+        values = (self.elseget,) + tuple(self.get(key, _MISSING) for key in used)
+        if cached is not None and cached[1] == values:
+            self._dsns[schema] = (self._version, values, cached[2])
+            return cached[2]
         
         keys = set(self.keys())
         # Check if all the required keys are found in the loaded parse. 
         # (Uses subset notation, required is subset of self.keys())
-        # Also viable, required - set is empty
+        required, optional = set(definition['required']), set(definition['optional'])
         if not required <= keys:
-            self.log(f"Required keys {required - keys} not found, will not be able to connect to DB2.", "error")
-            raise Exception(f"Required keys {required - keys} not found, will not be able to connect to DB2.")
+            self.log(f"Required keys {required - keys} not found, will not be able to connect to {definition['label']}.", "error")
+            raise Exception(f"Required keys {required - keys} not found, will not be able to connect to {definition['label']}.")
         if not optional <= keys:
-            self.log(f"Optional keys {optional - keys} not found.", "debug")
-        
-        dsn = f"{self.get('dialect', self.elseget) if self.get('dialect') else 'db2'}"
-        dsn += f"{self.get('driver', self.elseget)}"
-        dsn += f"://{self.get('username', self.elseget)}"
-        dsn += f":{self.get('password', self.elseget)}"
-        dsn += f"@{self.get('host', self.elseget)}"
-        dsn += f":{self.get('port', self.elseget)}"
-        dsn += f"/{self.get('database', self.elseget)}"
-        if self.get('protocol'):
-            dsn += f";PROTOCOL={self.get('protocol', self.elseget)}"
-        if self.get('security'):
-            dsn += f";SECURITY={self.get('security', self.elseget)}" 
-        if self.get('sslcertificate'):
-            dsn += f";SSLSERVERCERTIFICATE={self.get('sslcertificate', self.elseget)}" 
-        if self.get('sslclientkeystore'):
-            dsn += f";SSLCLIENTKEYSTOREDB={self.get('sslclientkeystore', self.elseget)}" 
-        if self.get('sslclientstash'):
-            dsn += f";SSLCLIENTKEYSTASH={self.get('sslclientstash', self.elseget)}"
-        
-        self['dsn'] = dsn
-
-        return self
+            self.log(f"Optional keys {optional - keys} not found.", definition['optional_level'])
+        
+        pieces = []
+        for part in definition['parts']:
+            value = self.get(part.key)
+            if part.optional:
+                if value:
+                    pieces.append(part.template.format(value))
+            elif part.default is not None:
+                pieces.append(part.template.format(value or part.default))
+            else:
+                pieces.append(part.template.format(self.get(part.key, self.elseget)))
+        dsn = ''.join(pieces)
+        self._dsns[schema] = (self._version, values, dsn)
+        return dsn
+    
+    def freeze(self, path, mode=0o600):
+        """
+        Writes this config to path as a frozen snapshot, see FrozenConfig. Only the keys and values go in,
+        none of the logging state. The file is written next to path and renamed over it in one step, so 
+        processes attaching to it never see half a file. Keys have to be strings, values can be anything 
+        marshal can write (strings, numbers, None, and lists/dicts of those). Returns path.
+        mode is the snapshot's permissions, owner only by default since configs carry passwords. Pass a 
+        wider one only if the processes attaching to it run as other users and the config holds no secrets.
+        """
+        keys = list(self.keys())
+        if any(type(key) is not str for key in keys):
+            self.log("Only configs with string keys can be frozen.", "error")
+            raise Exception("Only configs with string keys can be frozen.")
+        
+        entries, key_data, value_data = [], bytearray(), bytearray()
+        for key in sorted(keys, key=lambda key: key.encode('utf-8')):
+            value = self[key]
+            if type(value) is str:
+                kind, encoded = FrozenConfig.TEXT, value.encode('utf-8')
+            else:
+                try:
+                    kind, encoded = FrozenConfig.MARSHAL, marshal.dumps(value)
+                except ValueError:
+                    self.log(f"Value of {key} can't be frozen, it's a {type(value).__name__}.", "error")
+                    raise Exception(f"Value of {key} can't be frozen, it's a {type(value).__name__}.")
+            encoded_key = key.encode('utf-8')
+            entries.append((len(key_data), len(encoded_key), len(value_data), len(encoded), kind))
+            key_data += encoded_key
+            value_data += encoded
+        
+        header_size = FrozenConfig.HEADER.size + FrozenConfig.ENTRY.size * len(entries)
+        keys_start, values_start = header_size, header_size + len(key_data)
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+        try:
+            with open(handle, 'wb') as frozen:
+                frozen.write(FrozenConfig.HEADER.pack(FrozenConfig.MAGIC, len(entries)))
+                for key_offset, key_length, value_offset, value_length, kind in entries:
+                    frozen.write(FrozenConfig.ENTRY.pack(keys_start + key_offset, key_length, values_start + value_offset, value_length, kind))
+                frozen.write(key_data)
+                frozen.write(value_data)
+                frozen.flush()
+                os.fsync(frozen.fileno())
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return path
     
     def _clean_inputs(self, key, value):
         """
@@ -170,67 +421,69 @@ class ConfigParser(dict):
         """
         key = key.lower().strip()
         if value == '' or value == None:
-            self.log(f"Key {key} has an empty value.", "warning")
+            self.log("Key %s has an empty value.", "warning", key)
         elif type(value) == str:
             value = value.lower().strip()
         
         return key, value
     
-    def log(self, message, level='warn'):
+    def log(self, message, level='warn', *args):
         """
         Function to facilitate logging before an actual log file location has been created. 
         If a log file has already been made (self.logger), logging is straight forward a la the logging 
-        module. Only exceptions, info, error, and warning levels are logged at this time. 
+        module. Debug, info, warning, error and exception levels are logged. Anything below log_level
+        is thrown away first thing, before the message is formatted or stored.
+        
+        Like the logging module, args are %-formatted into message only if it's actually going to be 
+        logged: self.log("Key %s has an empty value.", "warning", key). An f-string works too, it just gets
+        built whether or not it's logged.
         
         If a log file has yet to have been created, the parser checks if the logging path has been loaded
         into itself yet. This path MUST be called the `configparserlogpath`. This path is then used to 
         create either a standard python logger or a logging object customized via py_base. Whichever package
-        is imported as logging will determine which is used. 
+        is imported as logging will determine which is used. The standard logger doesn't write anything
+        itself, see queue_logger, so logging never waits on the disk. 
         
         Once a log file has been created all messages stored in the backlog (next section) are logged, then
         the message that was passed into this call of the log function is logged. 
         
-        If no log file exists and the path is not in this object, logging is done via print statements. The
-        prints are prepended with the level of log. The message and log level are also stored in the backlog,
-        which once a log file has been created, will be logged into the log file proper. 
+        If no log file exists and the path is not in this object, logging is done via print statements
+        for anything at console_level or above. The prints are prepended with the level of log. The message
+        and log level are also stored in the backlog, which once a log file has been created, will be logged
+        into the log file proper. 
         """
+        levelno = LOG_LEVELS.get(level)
+        if levelno is None or levelno < self.log_level:
+            return
+        if self.logger is None and 'configparserlogpath' in self:
+            self._start_logging()
+        
         if self.logger: # Log was already created. 
             if level == 'exception':
                 # Message would have to be a tuple; exception logs demand a exc_info keyword value.
                 # Use Error unless you actually want an exception trace. 
-                self.logger.exception(message[0], exc_info=message[1])
-            elif level == 'info': 
-                self.logger.info(message)
-            elif level == 'error':
-                self.logger.error(message)
-            elif level == 'warn' or level == 'warning':
-                self.logger.warning(message)
-        else: # Logging hasn't been created yet. 
-            if 'configparserlogpath' in self: # if you have a path to use
-                
-                os.makedirs(self['configparserlogpath'], exist_ok=True)
-                if 'py_base' in logging.__file__: # Custom Logging
-                    self.logger = logging.createLog('ConfigParser', self['configparserlogpath'])
-                else: # Default Logging Package
-                    logging.basicConfig(filename=os.path.join(self['configparserlogpath'], 'ConfigParser.basic.log'), level=logging.NOTSET)
-                    self.logger = logging
-                
-                # Run all printed messages through the logger
-                # TODO: Get this to not print the already printed messages (via print). Might be hard. 
-                for x in self.backlog:
-                    self.log(x[0], x[1])
-                
-                self.log(message, level)
-            else: # No path, no log, you get prints. 
-                self.backlog.append((message, level))
-                if level == 'exception':
-                    print('EXCEPTION: '+message)
-                elif level == 'info': 
-                    print('INFO: '+message)
-                elif level == 'error':
-                    print('ERROR: '+message)
-                elif level == 'warn' or level == 'warning':
-                    print('WARNING: '+message)
+                self.logger.exception(message[0], *args, exc_info=message[1])
+            else:
+                getattr(self.logger, LOG_METHODS[level])(message, *args)
+        else: # No path, no log, you get prints. 
+            self.backlog.append((message, level, args))
+            if levelno >= self.console_level:
+                text = message[0] if level == 'exception' else message
+                print(f"{level.upper() if level != 'warn' else 'WARNING'}: " + (text % args if args else text))
+    
+    def _start_logging(self):
+        """Creates the logger once there's a `configparserlogpath`, and empties the backlog into it."""
+        if 'py_base' in logging.__file__: # Custom Logging
+            os.makedirs(self['configparserlogpath'], exist_ok=True)
+            self.logger = logging.createLog('ConfigParser', self['configparserlogpath'])
+        else: # Default Logging Package, written from a background thread.
+            self.logger = queue_logger(self['configparserlogpath'])
+        
+        # Run all printed messages through the logger
+        # TODO: Get this to not print the already printed messages (via print). Might be hard. 
+        while self.backlog:
+            message, level, args = self.backlog.popleft()
+            self.log(message, level, *args)
 
 class JsonConfigParser(ConfigParser):
     
@@ -238,9 +491,35 @@ class JsonConfigParser(ConfigParser):
     Implements loading a JSON configuration file. All functions other than Parser are inherited from
     the super class ConfigParser above. An example of the configuration file used to develop this
     class can be found in ../../tests/sample_credentials.json. 
+    
+    Parsed files are cached for the whole process, shared by every JsonConfigParser. Services that make
+    a parser per request or per worker only pay for reading and cleaning a file once, see parse.
     """
+    
+    # (absolute path, sub_keys, clean) -> (file signature, read only view of the values loaded with dicts and
+    # lists left as None, those dicts and lists as JSON text or None if there weren't any)
+    _cache = {}
+    _cache_lock = threading.Lock()
+    
+    # Files bigger than this are streamed when sub_keys are given, see _stream_sub_tree.
+    stream_threshold = 1024 * 1024
+    # Pieces of JSON _stream_sub_tree needs to find, all in bytes since it works on the raw file.
+    _whitespace = re.compile(rb'[ \t\n\r]*')
+    _string = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+    _scalar = re.compile(rb'[^,}\]\s]*')
+    # Everything up to the next bracket that isn't inside a string, then the bracket. Objects and arrays
+    # with no brackets in them (the bulk of a config file) are jumped over whole along the way.
+    _to_bracket = re.compile(rb'[^"\[\]{}]*(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"'
+                             rb'|\{[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*\}'
+                             rb'|\[[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*\])[^"\[\]{}]*)*([\[\]{}])', re.DOTALL)
+    
+    @classmethod
+    def clear_cache(cls):
+        """Forgets every parsed file, the next parse of each reads it fresh."""
+        with cls._cache_lock:
+            cls._cache.clear()
         
-    def parse(self, json_file, sub_keys=[]):
+    def parse(self, json_file, sub_keys=[], cache=True, stream=None):
         """
         Loads a json file, throwing errors if the json file is not found or it was not able to be 
         parsed as json via the json module, and imports the selected values into this object.
@@ -263,33 +542,177 @@ class JsonConfigParser(ConfigParser):
         Examples of this can be seen in the "Json Parse Test" of the unit tests.
         
         Key value pairs are only cleaned before insertion if the class variable `clean` is set to true.
+        
+        With cache on, what was loaded is kept for next time, keyed by the file's absolute path, sub_keys 
+        and clean. The file is checked with a single stat each call: if it's modification time, size and 
+        inode haven't changed since it was parsed, the cached values are copied in instead of reading 
+        anything. Strings, numbers and the like are shared with the cache, they can't be changed anyway. 
+        Dict and list values are kept as one piece of JSON text and decoded fresh on each hit, which is 
+        a good deal quicker than deep copying them, so nothing done to one parser shows up in another. 
+        Warnings from cleaning are logged on every parse either way.
+        
+        stream controls how a file with sub_keys is read. Streaming walks the raw file to the sub_keys and 
+        only decodes what's under them, skipping every sibling without building it, so the time and memory 
+        it takes depend on how big the part you asked for is rather than how big the file is. The catch is
+        that the parts skipped over aren't checked, a typo in some other tenant's section won't be noticed.
+        None (the default) streams files over stream_threshold bytes, True and False force it either way.
         """
-        if not os.path.isfile(json_file):
+        if type(sub_keys) is str: sub_keys = [sub_keys]
+        try:
+            file_stat = os.stat(json_file)
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
             self.log(f"Path {json_file} not found", "error")
             raise Exception(f"Path {json_file} not found")
+        
+        if not cache:
+            self.update(self._load_file(json_file, sub_keys, stream))
+            return self
+        key = (os.path.abspath(json_file), tuple(sub_keys), self.clean)
+        signature = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached[0] == signature:
+            _, values, nested = cached
+            nested = {} if nested is None else json.loads(nested)
+            if 'configparserlogpath' in values:
+                self['configparserlogpath'] = values['configparserlogpath']
+            if self.clean: # Same warnings _clean_inputs would have given reading the file.
+                for x, y in values.items():
+                    if x not in nested and (y == '' or y == None):
+                        self.log("Key %s has an empty value.", "warning", x)
+            self.update(values) # Dicts and lists are None here, the decoded copies land in the same spots.
+            self.update(nested)
+            return self
+        
+        values = self._load_file(json_file, sub_keys, stream)
+        containers = {x: y for x, y in values.items() if isinstance(y, (dict, list))}
+        shared = types.MappingProxyType({x: None if x in containers else y for x, y in values.items()})
+        with self._cache_lock:
+            self._cache[key] = (signature, shared, json.dumps(containers) if containers else None)
+        self.update(values)
+        return self
+    
+    def _load_file(self, json_file, sub_keys, stream=None):
+        """parse without the cache. Reads json_file and returns the (cleaned) values to load."""
+        if stream is None:
+            stream = bool(sub_keys) and os.path.getsize(json_file) > self.stream_threshold
         try:
-            json_data = json.loads(open(json_file).read())
+            if stream and sub_keys:
+                json_data = self._stream_sub_tree(json_file, sub_keys)
+                walk = []
+            else:
+                json_data = json.loads(open(json_file).read())
+                walk = sub_keys
+        except KeyError as e:
+            self.log(f"Sub key {e.args[0]} not found from sub key list {sub_keys}", "error")
+            raise Exception(f"Sub key {e.args[0]} not found from sub key list {sub_keys}")
         except:
             self.log(f"File at {json_file} was unable to be read as JSON.", "error")
             raise Exception(f"File at {json_file} was unable to be read as JSON.")
         
-        if sub_keys: # Navigate down the JSON 'tree' to a specific key. Can go multiple layers down. 
-            if type(sub_keys) is str: sub_keys = [sub_keys]
-            for k in sub_keys:
-                if k not in json_data.keys():
+        if walk: # Navigate down the JSON 'tree' to a specific key. Can go multiple layers down. 
+            for k in walk:
+                if not isinstance(json_data, dict) or k not in json_data:
                     self.log(f"Sub key {k} not found from sub key list f{sub_keys}", "error")
                     raise Exception(f"Sub key {k} not found from sub key list {sub_keys}")
                 json_data = json_data[k]
         
+        if not isinstance(json_data, dict):
+            self.log(f"File at {json_file} doesn't hold a JSON object at {sub_keys}.", "error")
+            raise Exception(f"File at {json_file} doesn't hold a JSON object at {sub_keys}.")
+        
         # Add all data from the JSON to this object.
+        values = {}
         for x, y in json_data.items():
             if self.clean:
-                x_clean, y_clean = self._clean_inputs(x,y)
-                self[x_clean] = y_clean
-            else:
+                x, y = self._clean_inputs(x,y)
+            values[x] = y
+            if x == 'configparserlogpath': # Anything logged from here on can go to the log file.
                 self[x] = y
             
-        return self
+        return values
+        
+    def _stream_sub_tree(self, json_file, sub_keys):
+        """
+        Finds the value at sub_keys in json_file without decoding anything else, and returns just that value
+        decoded. The file is memory mapped and walked one object at a time: at each level keys are read until
+        the next sub key turns up, and the value of every other key is jumped over, strings in one regex 
+        and objects/arrays by counting brackets (skipping any in strings), never turning them into Python 
+        objects. Raises KeyError with the missing sub key, or ValueError when the JSON is broken along the way.
+        
+        The file has to be UTF-8 (or plain ASCII), like json.loads assumes, anything else is read in full instead.
+        """
+        with open(json_file, 'rb') as raw_file:
+            head = raw_file.read(4)
+            if b'\x00' in head or head[:2] in (b'\xff\xfe', b'\xfe\xff'): # UTF-16/32, not streamable.
+                raw_file.seek(0)
+                json_data = json.loads(raw_file.read())
+                for k in sub_keys:
+                    if not isinstance(json_data, dict) or k not in json_data:
+                        raise KeyError(k)
+                    json_data = json_data[k]
+                return json_data
+            with mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                pos = 3 if buffer[:3] == b'\xef\xbb\xbf' else 0
+                for k in sub_keys:
+                    pos = self._find_key(buffer, self._whitespace.match(buffer, pos).end(), k)
+                end = self._skip_value(buffer, pos)
+                return json.loads(buffer[pos:end])
+    
+    def _find_key(self, buffer, pos, key):
+        """
+        Given the start of an object in buffer, returns where the value of key in it starts. The whole object 
+        is read even after key turns up: with the key in there more than once it's the last one that counts,
+        same as json.loads.
+        """
+        if buffer[pos:pos + 1] != b'{':
+            raise KeyError(key)
+        pos += 1
+        found = None
+        while True:
+            pos = self._whitespace.match(buffer, pos).end()
+            if buffer[pos:pos + 1] == b'}':
+                if found is None:
+                    raise KeyError(key)
+                return found
+            string = self._string.match(buffer, pos)
+            if string is None:
+                raise ValueError(f"Expected a key at byte {pos}")
+            name = string.group()
+            name = json.loads(name) if b'\\' in name else name[1:-1].decode('utf-8')
+            pos = self._whitespace.match(buffer, string.end()).end()
+            if buffer[pos:pos + 1] != b':':
+                raise ValueError(f"Expected ':' at byte {pos}")
+            pos = self._whitespace.match(buffer, pos + 1).end()
+            if name == key:
+                found = pos
+            pos = self._whitespace.match(buffer, self._skip_value(buffer, pos)).end()
+            if buffer[pos:pos + 1] == b',':
+                pos += 1
+            elif buffer[pos:pos + 1] != b'}':
+                raise ValueError(f"Expected ',' or '}}' at byte {pos}")
+    
+    def _skip_value(self, buffer, pos):
+        """Given the start of any JSON value in buffer, returns where it ends."""
+        first = buffer[pos:pos + 1]
+        if first == b'"':
+            string = self._string.match(buffer, pos)
+            if string is None:
+                raise ValueError(f"Unterminated string at byte {pos}")
+            return string.end()
+        if first not in (b'{', b'['):
+            return self._scalar.match(buffer, pos).end()
+        pos, depth = pos + 1, 1
+        while True:
+            bracket = self._to_bracket.match(buffer, pos)
+            if bracket is None:
+                raise ValueError(f"Unbalanced brackets after byte {pos}")
+            pos = bracket.end()
+            depth += 1 if bracket.group(1) in (b'{', b'[') else -1
+            if depth == 0:
+                return pos
         
 class EnvConfigParser(ConfigParser):
         
@@ -301,7 +724,7 @@ class EnvConfigParser(ConfigParser):
     The environment variables are filtered through using a prefix or straight regex. 
     """
         
-    def parse(self, env_prefix, regex=False, trim=False):
+    def parse(self, env_prefix, regex=False, trim=False, indexed=False):
         """
         The parse function operates differently based on if regex is True or False. When False, 
         the env_prefix is a prefix value that must be matched by an environment variable for it to
@@ -325,31 +748,480 @@ class EnvConfigParser(ConfigParser):
         fairly amigious names compared to `prod_db2_ny_database`. 
         
         Finally, parse will produce an error BUT NOT CRASH when no matches were found for the provided pattern. 
+        
+        A prefix that's plain text (no regex characters in it, the usual 'tdd_dev_db_') is never run as a
+        regex at all, just str.startswith. With indexed it's looked up in a sorted index of the environment 
+        variable names (see refresh) with a binary search instead, and only the variables starting with it
+        are touched. The index is a snapshot though, so only use it when the names in the environment don't
+        change, or call refresh when they do. Anything else is compiled once and reused by every parser after.
         """
+        if not regex and self._is_plain(env_prefix):
+            matches = self._parse_prefix(env_prefix, trim, indexed)
+            if matches == 0:
+                self.log(f"There were no matches found for pattern '{env_prefix}(?P<var>.*)'", "error")
+            return self
         
+        pattern = self._pattern(env_prefix, regex, trim)
+        matches = 0
+        for x, y in os.environ.items():
+            match = pattern.match(x)
+            if match:
+                self._add(x, y, match, trim)
+                matches+=1
+        if matches == 0:
+            self.log(f"There were no matches found for pattern '{pattern.pattern}'", "error")
+        return self
+    
+    @classmethod
+    def parse_many(cls, env_prefixes, regex=False, trim=False, clean=True, indexed=False):
+        """
+        parse for several prefixes at once, ie every environment's database variables, returning a 
+        {prefix: EnvConfigParser} dictionary. Every prefix, plain or regex, is matched in one single pass 
+        over the environment rather than a pass each; with indexed, plain prefixes get a look up in the 
+        index each instead. Arguments mean the same as they do for parse, and apply to every prefix. 
+            configs = EnvConfigParser.parse_many(['tdd_dev_db_', 'tdd_prod_db_'], trim=True)
+            configs['tdd_prod_db_'].validate_db2()['db2dsn']
+        """
+        parsers = {env_prefix: cls(clean) for env_prefix in env_prefixes}
+        matches = dict.fromkeys(parsers, 0)
+        plain, patterns = [], []
+        for env_prefix, parser in parsers.items():
+            if not regex and cls._is_plain(env_prefix):
+                if indexed:
+                    matches[env_prefix] = parser._parse_prefix(env_prefix, trim, indexed)
+                else:
+                    plain.append((env_prefix, parser))
+            else:
+                patterns.append((env_prefix, parser, parser._pattern(env_prefix, regex, trim)))
+        if plain or patterns:
+            # Names starting with none of the plain prefixes are thrown out by one str.startswith call.
+            starts = tuple(env_prefix for env_prefix, _ in plain)
+            for x, y in os.environ.items():
+                if starts and x.startswith(starts):
+                    for env_prefix, parser in plain:
+                        if x.startswith(env_prefix):
+                            parser._add(x, y, x[len(env_prefix):], trim)
+                            matches[env_prefix] += 1
+                for env_prefix, parser, pattern in patterns:
+                    match = pattern.match(x)
+                    if match:
+                        parser._add(x, y, match, trim)
+                        matches[env_prefix] += 1
+        for env_prefix, parser in parsers.items():
+            if matches[env_prefix] == 0:
+                parser.log(f"There were no matches found for prefix '{env_prefix}'", "error")
+        return parsers
+    
+    @classmethod
+    def refresh(cls):
+        """
+        Rebuilds the sorted index of environment variable names that indexed parses look plain prefixes up
+        in. The index is shared by every EnvConfigParser and built the first time it's needed. Only the NAMES
+        are kept, values are always read straight out of os.environ, so a changed value is seen right away, 
+        and a removed variable is skipped.
         
-        envs = os.environ
+        The index is a snapshot, nothing rebuilds it but this. Call it after adding or renaming environment
+        variables, or those variables won't be found by an indexed parse.
+        """
+        names = sorted(os.environ)
+        cls._index = names
+        return names
+    
+    _index = None
+    # Characters that make a prefix a regex rather than plain text.
+    _regex_characters = re.compile(r'[.^$*+?{}\[\]\\|()]')
+    # Finds the named group trim needs in a pattern.
+    _var_group = re.compile(r'\(\?P<var>.*?\)')
+    _compiled = {}
+    
+    @classmethod
+    def _is_plain(cls, env_prefix):
+        return not cls._regex_characters.search(env_prefix)
+    
+    def _parse_prefix(self, env_prefix, trim, indexed=False):
+        """parse for a plain text prefix, see parse. Returns the number of variables loaded."""
+        matches = 0
+        if not indexed:
+            for x, y in os.environ.items():
+                if x.startswith(env_prefix):
+                    self._add(x, y, x[len(env_prefix):], trim)
+                    matches+=1
+            return matches
+        names = self._index
+        if names is None:
+            names = self.refresh()
+        environ = os.environ
+        for i in range(bisect.bisect_left(names, env_prefix), len(names)):
+            x = names[i]
+            if not x.startswith(env_prefix):
+                break
+            y = environ.get(x)
+            if y is None: # Removed since the index was built.
+                continue
+            self._add(x, y, x[len(env_prefix):], trim)
+            matches+=1
+        return matches
+    
+    def _pattern(self, env_prefix, regex, trim):
+        """The compiled pattern parse matches variable names against, checked for trim's group."""
         pattern = f'{env_prefix}(?P<var>.*)' if not regex else env_prefix
-
-        if trim and not re.search('\(?P<var>.*?\)', pattern):
+        if trim and not self._var_group.search(pattern):
             self.log(f"regex `(?P<var>...)` not found in your pattern `{pattern}`, will not be able to trim.", "error")
             raise Exception(f"regex `(?P<var>...)` not found in your pattern `{pattern}`, will not be able to trim.")
+        compiled = self._compiled.get(pattern)
+        if compiled is None:
+            compiled = self._compiled[pattern] = re.compile(pattern)
+        return compiled
+    
+    def _add(self, x, y, var, trim):
+        """Loads one variable. var is the trimmed name, either the text itself or the regex match holding it."""
+        if self.clean:
+            if trim:
+                x = var if type(var) is str else var.group('var')
+            x_clean, y_clean = self._clean_inputs(x,y)
+            self[x_clean] = y_clean
+        else:
+            self[x] = y
+
+class LayeredConfigParser(ConfigParser):
+    
+    """
+    Stacks several configuration sources into one, the way defaults, a per environment file, environment
+    variables and overrides usually get combined with dict.update by hand. Each layer is a source of its own
+    and later layers win: a key comes from the top-most layer that has it, and falls through to the layers
+    under it when it doesn't.
+        config = LayeredConfigParser()
+        config.add_layer('defaults', lambda: JsonConfigParser().parse('defaults.json'))
+        config.add_layer('prod', lambda: JsonConfigParser().parse('shared.json', ['prod']))
+        config.add_layer('env', lambda: EnvConfigParser().parse('tdd_prod_db_', trim=True))
+        config.add_layer('overrides', {'port': '50001'})
+        config.parse_db2()
+    
+    The merged result is this object itself, so lookups are a single dictionary lookup no matter how many
+    layers there are, and safe from other threads while layers reload: a key stays put unless the new 
+    merge drops it (see _merge). It's also published as snapshot, a read only view of a frozen copy that's replaced
+    (never changed) whenever the layers are merged again, so other threads can hold and read it freely.
+    Reloading one layer only parses that layer again, every other layer's last values are reused.
+    """
+    
+    def __init__(self, clean=True):
+        super().__init__(clean)
+        self.layers = collections.OrderedDict() # name -> source, bottom layer first
+        self.values = {}                        # name -> what the layer's source last gave back
+        self.snapshot = types.MappingProxyType({})
+        self._validated = []
+        self._layer_lock = threading.RLock()
+    
+    def add_layer(self, name, source, below=None):
+        """
+        Adds a layer on top of the others (or under the layer named below). source is either a function 
+        taking no arguments that returns the layer's values (a parser, usually a lambda around one) or a 
+        plain dictionary of values. Nothing is loaded until parse or reload. Returns self for chaining.
+        """
+        with self._layer_lock:
+            if name in self.layers:
+                self.log(f"Layer {name} already exists, use reload or remove it first.", "error")
+                raise Exception(f"Layer {name} already exists, use reload or remove it first.")
+            if below is not None and below not in self.layers:
+                self.log(f"Layer {below} to put {name} under doesn't exist.", "error")
+                raise Exception(f"Layer {below} to put {name} under doesn't exist.")
+            self.layers[name] = source
+            if below is not None:
+                names = list(self.layers)
+                for layer in names[names.index(below):-1]:
+                    self.layers.move_to_end(layer)
+        return self
+    
+    def remove_layer(self, name):
+        """Takes a layer out and merges again without it."""
+        with self._layer_lock:
+            del self.layers[name]
+            self.values.pop(name, None)
+            self._merge()
+        return self
+    
+    def parse(self):
+        """Loads every layer and merges them. See reload to load just one again."""
+        with self._layer_lock:
+            for name in self.layers:
+                self.values[name] = self._load_layer(name)
+            self._merge()
+        return self
+    
+    def reload(self, name):
+        """Loads just the named layer again and merges, every other layer keeps the values it already had."""
+        with self._layer_lock:
+            if name not in self.layers:
+                self.log(f"No layer named {name}.", "error")
+                raise Exception(f"No layer named {name}.")
+            self.values[name] = self._load_layer(name)
+            self._merge()
+        return self
+    
+    def source(self, key):
+        """Name of the layer key's value comes from, None if no layer has it."""
+        for name in reversed(self.layers):
+            if key in self.values.get(name, ()):
+                return name
+        return None
+    
+    def validate(self, schema):
+        """ConfigParser.validate, remembered so the DSN is built again every time the layers are merged."""
+        super().validate(schema)
+        if schema not in self._validated:
+            self._validated.append(schema)
+            self.snapshot = types.MappingProxyType(dict(self))
+        return self
+    
+    def _load_layer(self, name):
+        source = self.layers[name]
+        values = source() if callable(source) else source
+        return dict(values)
+    
+    def _merge(self):
+        """
+        Merges the layers into this object, bottom to top, rebuilds any DSNs and publishes a new snapshot. 
+        The object is never emptied along the way: new values are written over the old ones, then keys no 
+        layer has any more are dropped, so a key that's in every version is always there for other threads.
+        DSNs stay in place until they're rebuilt, or dropped if they can't be any more.
+        """
+        merged = {}
+        for name in self.layers:
+            merged.update(self.values.get(name, {}))
+        outputs = {DSN_SCHEMAS[schema]['output'] for schema in self._validated}
+        dict.update(self, merged)
+        for key in [key for key in self if key not in merged and key not in outputs]:
+            dict.pop(self, key, None)
+        self._changed()
+        try:
+            for schema in self._validated:
+                ConfigParser.validate(self, schema)
+        except Exception:
+            for output in outputs:
+                dict.pop(self, output, None)
+            self._changed()
+            raise
+        finally:
+            self.snapshot = types.MappingProxyType(dict(self))
+
+class FrozenConfig(Mapping):
+    
+    """
+    A read only config attached to a file written by ConfigParser.freeze. Freeze once (in the parent of a 
+    pre-fork server, or a deploy step) and every worker attaches to the same file instead of parsing JSON
+    and holding it's own copy: the file is memory mapped, so the pages are shared by every process through 
+    the OS's page cache, and attaching reads nothing but an 8 byte header.
+    
+    The file is a header (magic, number of keys), a table of fixed size entries sorted by key, then every key
+    and every value packed end to end. Looking a key up is a binary search over the table, decoding only the 
+    keys it lands on, then decoding the one value: strings are stored as UTF-8, anything else with marshal.
+    It works like any other read only mapping (in, get, items...). Every lookup hands back a fresh value, 
+    so nothing a caller does to a list or dict they got changes the config.
+    """
+    
+    MAGIC = b'CFGSNAP1'
+    HEADER = struct.Struct('<8sI')
+    # key offset, key length, value offset, value length, value kind
+    ENTRY = struct.Struct('<IIIIB3x')
+    TEXT = 0
+    MARSHAL = 1
+    
+    def __init__(self, path):
+        with open(path, 'rb') as frozen:
+            self._buffer = mmap.mmap(frozen.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = self.HEADER.unpack_from(self._buffer, 0)
+        if magic != self.MAGIC:
+            self._buffer.close()
+            raise Exception(f"File at {path} isn't a frozen config.")
+        self.path = path
+    
+    @classmethod
+    def attach(cls, path):
+        """Same as FrozenConfig(path), reads better next to ConfigParser.freeze."""
+        return cls(path)
+    
+    def _entry(self, index):
+        return self.ENTRY.unpack_from(self._buffer, self.HEADER.size + index * self.ENTRY.size)
+    
+    def _find(self, key):
+        """Table entry for key, or None."""
+        if type(key) is not str:
+            return None
+        target = key.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            found = self._buffer[entry[0]:entry[0] + entry[1]]
+            if found == target:
+                return entry
+            if found < target:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+    
+    def __getitem__(self, key):
+        entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        _, _, value_offset, value_length, kind = entry
+        value = self._buffer[value_offset:value_offset + value_length]
+        return value.decode('utf-8') if kind == self.TEXT else marshal.loads(value)
+    
+    def __contains__(self, key):
+        return self._find(key) is not None
+    
+    def __iter__(self):
+        for index in range(self._count):
+            key_offset, key_length = self._entry(index)[:2]
+            yield self._buffer[key_offset:key_offset + key_length].decode('utf-8')
+    
+    def __len__(self):
+        return self._count
+    
+    def __repr__(self):
+        return f"FrozenConfig({self.path!r})"
+    
+    def thaw(self, parser_class=None):
+        """Copies the snapshot back into a regular, changeable ConfigParser (or the given subclass)."""
+        parser = (parser_class or ConfigParser)(clean=False)
+        dict.update(parser, self.items())
+        parser._changed()
+        return parser
+    
+    def close(self):
+        self._buffer.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ConfigWatcher(object):
+    
+    def __init__(self, load, paths=None, interval=1.0):
+        """
+        Keeps a configuration up to date in the background, instead of parsing it again on every request. 
+        load is whatever builds the config, called with no arguments, and paths are the files it reads:
+            watcher = ConfigWatcher(lambda: JsonConfigParser().parse_db2('creds.json', ['db2']), ['creds.json'])
+            watcher.on_change(rebuild_pool, keys=['db2dsn'])
+            watcher.start()
+            ...
+            watcher.config['db2dsn']
         
-        matches = 0
-        for x, y in envs.items():
-            match = re.match(pattern, x)
-            if match:
-                if self.clean:
-                    if trim:
-                        x = match.group('var')
-                    x_clean, y_clean = self._clean_inputs(x,y)
-                    self[x_clean] = y_clean
-                else:
-                    self[x] = y
-                matches+=1
-        if matches == 0:
-            self.log(f"There were no matches found for pattern '{pattern}'", "error")
+        With paths, a background thread sleeps until one of the files changes (inotify where there is one,
+        stat polling every interval seconds otherwise, see fswatch.Watcher) and only reloads when a file's 
+        inode, size or modification time really moved. Without paths (environment variables, which nothing 
+        announces changes to) it reloads every interval seconds. Either way, the old and new configs are 
+        compared and callbacks are only called when keys they care about actually changed. 
+        
+        A load that fails (like a credentials file caught half written) is logged and the last good config 
+        is kept, the next change tries again. The first load happens right here, so a bad config fails loudly.
+        The watcher logs through a ConfigParser of it's own, since load can hand back any mapping (a dict,
+        a FrozenConfig...). It writes to the loaded config's configparserlogpath when it has one.
+        
+        The files are stat'd before the first load, so a change that lands while it's loading still 
+        counts as a change and gets picked up.
+        """
+        self.load = load
+        self.paths = [os.path.abspath(path) for path in paths or []]
+        self.interval = interval
+        self.callbacks = []
+        self.logger = ConfigParser(clean=False)
+        self._signatures = self._stat_paths()
+        self.config = load()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+    
+    def on_change(self, callback, keys=None):
+        """
+        Calls callback(changes) after a reload that changed anything in keys (any key, when keys is None).
+        changes is {key: (old value, new value)} for just those keys, a key that's gone has None as it's new 
+        value and a new key has None as it's old one. Callbacks run on the watcher's thread.
+        """
+        self.callbacks.append((callback, None if keys is None else set(keys)))
+        return callback
+    
+    def start(self):
+        """Starts watching on a daemon thread. Returns the watcher, so it can be chained off the constructor."""
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='ConfigWatcher', daemon=True)
+            self._thread.start()
         return self
+    
+    def stop(self):
+        """Stops the watching thread and waits for it to finish whatever reload it's in the middle of."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+    
+    def reload(self):
+        """
+        Loads the config again now, swaps it in and calls the callbacks for what changed. Returns the changes,
+        {key: (old, new)}, empty when nothing did. Normally the watching thread calls this, but nothing stops
+        you calling it yourself.
+        """
+        with self._lock:
+            try:
+                config = self.load()
+            except Exception as e:
+                self._log(f"Reload failed, keeping the last config: {e}")
+                return {}
+            old, self.config = self.config, config
+        
+        changes = {}
+        for key in old.keys() | config.keys():
+            before, after = old.get(key, _MISSING), config.get(key, _MISSING)
+            if before != after:
+                changes[key] = (None if before is _MISSING else before, None if after is _MISSING else after)
+        if not changes:
+            return changes
+        for callback, keys in self.callbacks:
+            wanted = changes if keys is None else {key: change for key, change in changes.items() if key in keys}
+            if wanted:
+                try:
+                    callback(wanted)
+                except Exception as e:
+                    self._log(f"Config change callback {callback} failed: {e}")
+        return changes
+    
+    def _log(self, message):
+        """Logs an error, to the config's own log file once the config says where that is."""
+        path = self.config.get('configparserlogpath')
+        if path and 'configparserlogpath' not in self.logger:
+            self.logger['configparserlogpath'] = path
+        self.logger.log(message, "error")
+    
+    def _stat_paths(self):
+        from fswatch import stat_signature
+        return [stat_signature(path) for path in self.paths]
+    
+    def _run(self):
+        if not self.paths:
+            while not self._stopping.wait(self.interval):
+                self.reload()
+            return
+        
+        from fswatch import Watcher
+        with Watcher(self.paths, interval=self.interval) as watcher:
+            while not self._stopping.is_set():
+                # Short waits, so stop() never has to wait long for the thread.
+                watcher.wait(min(self.interval, 0.5))
+                signatures = self._stat_paths()
+                if signatures != self._signatures:
+                    self._signatures = signatures
+                    self.reload()
         
 
 def unit_tests():
@@ -381,12 +1253,71 @@ def unit_tests():
     
     
     
-    """Db2/Database DDL JSON Parse"""
-    print(JsonConfigParser().parse_db2('../../tests/sample_credentials.json', ['db2'])['db2dsn'])
-    print(JsonConfigParser().parse_database('../../tests/sample_credentials.json', ['database'])['dsn'])
+    """JSON Cache Test"""
+    JsonConfigParser.clear_cache()
+    first = JsonConfigParser().parse('../../tests/test.json')
+    first['bar']['baz']['foo'] = 'changed'
+    second = JsonConfigParser().parse('../../tests/test.json')
+    print(second['bar']['baz']['foo'] == 'foo')
+    print(list(second.items()) == list(JsonConfigParser().parse('../../tests/test.json', cache=False).items()))
+    
     
     
+    """JSON Stream Test"""
+    # Streaming to the sub keys finds the same values as decoding the whole file, brackets and quotes in
+    # the siblings skipped over included, and a missing sub key is still an error.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stream.json')
+        with open(path, 'w') as stream_file:
+            json.dump({'skip': {'text': 'a } ] " { [', 'list': [{'x': '}'}, [1, 2]]}, 'esc\\aped': {'"': '{'},
+                       'env': {'skip': ['[', ']'], 'other': {}, 'db2': {'database': 'BLUDB', 'ports': [50000, 50001]}}}, stream_file)
+        for sub_keys in (['env', 'db2'], ['esc\\aped'], ['env', 'other'], ['env', 'skip']):
+            try:
+                streamed = JsonConfigParser(clean=False).parse(path, sub_keys, cache=False, stream=True)
+                print(dict(streamed) == dict(JsonConfigParser(clean=False).parse(path, sub_keys, cache=False, stream=False)))
+            except Exception as e:
+                print(e)
+        try:
+            JsonConfigParser(clean=False).parse(path, ['env', 'db3'], cache=False, stream=True)
+        except Exception as e:
+            print(e)
+        # A key given twice, the last one wins either way.
+        with open(path, 'w') as stream_file:
+            stream_file.write('{"env": {"host": "first"}, "other": 1, "env": {"host": "last"}}')
+        print(dict(JsonConfigParser(clean=False).parse(path, ['env'], cache=False, stream=True)),
+              dict(JsonConfigParser(clean=False).parse(path, ['env'], cache=False, stream=False)))
+
     
+    
+    """Db2/Database DDL JSON Parse"""
+    print(JsonConfigParser().parse_db2('../../tests/sample_credentials.json', ['db2'])['db2dsn'])
+    print(JsonConfigParser().parse_database('../../tests/sample_credentials.json', ['database'])['dsn'])
+
+
+
+    """DSN Cache Test"""
+    # A copy shares the DSN cache with the original, but each still gets the DSN of it's own values, however
+    # many changes either goes through.
+    import copy
+    import pickle
+    hosts = set()
+    for changes in range(40):
+        original = JsonConfigParser(clean=False).parse_db2('../../tests/sample_credentials.json', ['db2'])
+        copied = copy.copy(original)
+        copied['host'] = 'OTHER'
+        copied.validate_db2()
+        for i in range(changes):
+            original[f'extra{i}'] = i
+        hosts.add(original.validate_db2()['db2dsn'].split(';')[2])
+    print(hosts, 'HOSTNAME=OTHER;' in copied['db2dsn'])
+    original['host'] = 'h'
+    print('HOSTNAME=h;' in original.validate_db2()['db2dsn'], 'HOSTNAME=OTHER;' in copied.validate_db2()['db2dsn'])
+    unpickled = pickle.loads(pickle.dumps(original))
+    unpickled['host'] = 'UNPICKLED'
+    print('HOSTNAME=UNPICKLED;' in unpickled.validate_db2()['db2dsn'])
+
+
+
     """Env Parse Test"""
     try:
         print(EnvConfigParser().parse('tdd_(dev|prod)_(.*)', regex=True, trim=True))
@@ -403,10 +1334,81 @@ def unit_tests():
     
     
     
+    """Env Index Test"""
+    # Plain prefixes are checked with startswith, regex ones matched in one pass, both at once here.
+    os.environ['tdd_index_a'] = 'one'
+    configs = EnvConfigParser.parse_many(['tdd_index_', 'tdd_(index)_'], trim=True)
+    print(dict(configs['tdd_index_']) == dict(configs['tdd_(index)_']) == {'a': 'one'})
+    # Several plain prefixes, overlapping ones included, load the same as parsing each on it's own.
+    configs = EnvConfigParser.parse_many(['tdd_dev_db_', 'tdd_prod_db_', 'tdd_'], trim=True)
+    print(all(dict(configs[prefix]) == dict(EnvConfigParser().parse(prefix, trim=True)) for prefix in configs))
+    # Without indexed every parse sees the environment as it is, renames included.
+    del os.environ['tdd_index_a']
+    os.environ['tdd_index_b'] = 'two'
+    print(dict(EnvConfigParser(clean=False).parse('tdd_index_')) == {'tdd_index_b': 'two'})
+    # The index is only built once asked for, and rebuilt by refresh().
+    EnvConfigParser.refresh()
+    print(dict(EnvConfigParser(clean=False).parse('tdd_index_', indexed=True)) == {'tdd_index_b': 'two'})
+    print(dict(EnvConfigParser.parse_many(['tdd_index_'], trim=True, indexed=True)['tdd_index_']) == {'b': 'two'})
+    del os.environ['tdd_index_b']
+    
+    
+    
     """Db2/Database DDL Env Parse"""
     print(EnvConfigParser().parse_db2('tdd_dev_db_', trim=True)['db2dsn'])
     print(EnvConfigParser().parse_database('tdd_dev_db_', trim=True)['dsn'])
     
+    
+    
+    """Layered Config Test"""
+    # Later layers win, a key falls through to the layers under it, and the DSN follows a reload.
+    overrides = {'port': '50002'}
+    layered = LayeredConfigParser()
+    layered.add_layer('file', lambda: JsonConfigParser().parse('../../tests/sample_credentials.json', ['db2']))
+    layered.add_layer('overrides', lambda: overrides)
+    layered.add_layer('defaults', {'port': '1', 'timeout': '30'}, below='file')
+    print(list(layered.layers))
+    layered.parse_db2()
+    print(layered['port'], layered.source('port'), layered['timeout'], layered.source('timeout'))
+    overrides = {}
+    layered.reload('overrides')
+    print(layered['port'] == layered.snapshot['port'] != '50002', layered.source('port'))
+    print(layered['db2dsn'] == layered.snapshot['db2dsn'] == JsonConfigParser().parse_db2('../../tests/sample_credentials.json', ['db2'])['db2dsn'])
+    layered.remove_layer('defaults')
+    print('timeout' in layered, 'timeout' in layered.snapshot)
+    
+    
+    
+    """Config Watcher Test"""
+    # A change to the file reaches the callback, a half written file is logged and the last good config
+    # kept, with the thread still watching for the next change.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'watched.json')
+        with open(path, 'w') as watched_file:
+            json.dump({'host': 'one', 'port': '1'}, watched_file)
+        changed = queue.Queue()
+        watcher = ConfigWatcher(lambda: JsonConfigParser(clean=False).parse(path), [path], interval=0.05)
+        watcher.on_change(changed.put, keys=['host'])
+        with watcher:
+            for text, timeout in (('{"host": "two", "port": "1"}', 5), ('{"host": "thr', 1), ('{"host": "three", "port": "2"}', 5)):
+                with open(path, 'w') as watched_file:
+                    watched_file.write(text)
+                try:
+                    print(changed.get(timeout=timeout))
+                except queue.Empty:
+                    print(watcher.config['host'], watcher._thread.is_alive())
+    
+    
+    
+    """Frozen Snapshot Test"""
+    db2config = JsonConfigParser().parse_db2('../../tests/sample_credentials.json', ['db2'])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'frozen.cfg')
+        with FrozenConfig.attach(db2config.freeze(path)) as frozen:
+            print(frozen['db2dsn'] == db2config['db2dsn'])
+            print(dict(frozen) == dict(db2config))
+            print(oct(os.stat(path).st_mode & 0o777) == '0o600')
+    
 
 if __name__ == '__main__':
     unit_tests()
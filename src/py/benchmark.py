@@ -0,0 +1,326 @@
+# Python version: 3.8+
+# TLDR: Times Pysed and the ConfigParsers against generated data so you can tell if a change actually made them faster
+# Why Should I use this?
+"""
+    * The 5 line regexsample.log proves nothing about speed
+    * Multi GB logs are the whole reason pysed has more than one way to read a file
+    * Baselines turn "feels faster" into a number you can diff
+"""
+# Changelog
+"""
+    * Created with the --mmap mode, compares it to the line loop
+    * Grew into the full suite: pysed modes, config parsing, startup time, peak memory and baselines
+    * --keywords compares --keywords-file to the giant alternation regex it replaces
+"""
+# Frantic Scribbling on the Wall
+"""
+    Every case runs in it's own fresh interpreter (this file, with --child), that's the only honest way to get
+    a peak RSS per case and it keeps one case's caches from flattering the next. The child prints one line
+    of JSON with what it measured and the parent puts the table together.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PYSED = os.path.join(HERE, 'pysed.py')
+
+LEVELS = ['INFO'] * 90 + ['DEBUG'] * 6 + ['WARNING'] * 3 + ['ERROR']
+MESSAGES = [
+    'request {n} served in {ms}ms',
+    'cache miss for key user:{n}',
+    'connection pool at {ms}% capacity',
+    'retrying job {n}, attempt {ms}',
+    'user {n} logged in from 10.0.{ms}.{n2}',
+]
+
+# name, pysed arguments. Together they cover search, group, substitute and line numbers.
+PYSED_CASES = [
+    ('search', ['-p', 'ERROR']),
+    ('group', ['-p', r'^(\S+ \S+) WARNING: (.*)']),
+    ('substitute', ['-p', r'user:(\d+)', '-s', r'user:<redacted>']),
+    ('line numbers', ['-l', '-p', 'WARNING']),
+]
+
+def parse_size(size):
+    """Turns a human size ('512M', '2G', '1024') into a number of bytes."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def generate_log(path, size, seed=0):
+    """
+    Writes a synthetic application log of roughly size bytes to path. Lines look like the ones in
+    ../../tests/regexsample.log with timestamps and some variety to them. Generating GBs line by line
+    takes longer than the benchmark does, so a few MB of random lines are built once and written over
+    and over, which makes no difference to the regex engine.
+    """
+    rand = random.Random(seed)
+    lines = []
+    for n in range(50000):
+        message = rand.choice(MESSAGES).format(n=rand.randint(1, 99999), n2=rand.randint(1, 254), ms=rand.randint(1, 999))
+        lines.append(f'2020-09-{rand.randint(1, 30):02d} {rand.randint(0, 23):02d}:{rand.randint(0, 59):02d} {rand.choice(LEVELS)}: {message}\n')
+    block = ''.join(lines).encode()
+
+    written = 0
+    with open(path, 'wb') as log:
+        while written < size:
+            chunk = block[:size - written] if size - written < len(block) else block
+            log.write(chunk)
+            written += len(chunk)
+    return path
+
+def generate_json_config(path, environments=500, tenants=100, seed=0):
+    """
+    Writes a shared configuration document shaped like ../../tests/sample_credentials.json, scaled up: every
+    environment has every tenant, each with a full set of database keys. The defaults make a file of a few
+    tens of MB. Returns the sub_keys of one tenant near the end, the worst case for anything walking the file.
+    """
+    rand = random.Random(seed)
+    document = {}
+    for e in range(environments):
+        document[f'env{e}'] = {
+            f'tenant{t}': {
+                'dialect': 'db2', 'driver': 'IBM DB2 ODBC DRIVER', 'database': f'BLUDB{t}',
+                'host': f'db{rand.randint(1, 999)}.downtherabbithole.com', 'username': f'alice{t}',
+                'password': ''.join(rand.choice('abcdefghijklmnop') for _ in range(16)), 'port': '50001',
+                'protocol': 'TCPIP', 'security': 'SSL', 'sslcertificate': f'/certs/{e}/{t}.arm',
+                'sslclientkeystore': f'/keys/{e}/{t}.kdb', 'sslclientstash': f'/keys/{e}/{t}.sth',
+            } for t in range(tenants)
+        }
+    with open(path, 'w') as config:
+        json.dump(document, config)
+    return [f'env{environments - 1}', f'tenant{tenants - 1}']
+
+def generate_env(count=5000, prefixes=('tdd_dev_db_', 'tdd_staging_db_', 'tdd_prod_db_'), seed=0):
+    """
+    Builds an environment like a busy container's: count unrelated variables plus a database's worth of
+    variables under each prefix, like ../../tests/sample_credentials.sh.
+    """
+    rand = random.Random(seed)
+    env = {f'SERVICE_{n}_{rand.choice(["HOST", "PORT", "TOKEN", "URL"])}': str(rand.random()) for n in range(count)}
+    for prefix in prefixes:
+        env.update({prefix + key: value for key, value in [
+            ('username', 'alice'), ('password', 'inwonderland'), ('database', 'BLUDB'),
+            ('host', 'downtherabbithole.com'), ('port', '50001'), ('dialect', 'db2'), ('driver', 'IBM DB2 ODBC DRIVER'),
+            ('protocol', 'TCPIP'), ('security', 'SSL'), ('sslcertificate', '/certs/db.arm'),
+            ('sslclientkeystore', '/keys/db.kdb'), ('sslclientstash', '/keys/db.sth'),
+        ]})
+    return env
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far. Linux reports KB, macOS bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def run_child(spec):
+    """
+    The --child side: runs one measurement described by spec and returns what it saw. Imports happen in
+    here so the parent never loads pysed or ConfigurationParser itself.
+    """
+    sys.path.insert(0, HERE)
+    if spec['kind'] == 'pysed':
+        import pysed
+        job = pysed.Pysed.from_argv(spec['argv'])
+        with open(os.devnull, 'w') as devnull:
+            start = time.perf_counter()
+            job.infer(devnull)
+            seconds = time.perf_counter() - start
+        return {'seconds': seconds, 'bytes': os.path.getsize(spec['argv'][-1]), 'rss_mb': peak_rss_mb()}
+
+    import ConfigurationParser
+    if spec['kind'] == 'json':
+        start = time.perf_counter()
+        for _ in range(spec['repeat']):
+            ConfigurationParser.JsonConfigParser().parse(spec['path'], spec['sub_keys'], cache=spec.get('cache', True), stream=spec.get('stream'))
+        seconds = time.perf_counter() - start
+        return {'seconds': seconds, 'bytes': os.path.getsize(spec['path']) * spec['repeat'], 'ops': spec['repeat'], 'rss_mb': peak_rss_mb()}
+    if spec['kind'] == 'env':
+        os.environ.update(generate_env(spec['count']))
+        start = time.perf_counter()
+        for _ in range(spec['repeat']):
+            ConfigurationParser.EnvConfigParser().parse_db2(spec['prefix'], trim=True, indexed=spec.get('indexed', False))
+        seconds = time.perf_counter() - start
+        return {'seconds': seconds, 'ops': spec['repeat'], 'rss_mb': peak_rss_mb()}
+    raise Exception(f"FATAL: Unknown benchmark kind {spec['kind']}")
+
+def measure(spec):
+    """Runs spec in a fresh interpreter (see run_child) and returns it's measurements."""
+    completed = subprocess.run([sys.executable, __file__, '--child', json.dumps(spec)], stdout=subprocess.PIPE, check=True)
+    return json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+def startup_seconds(repeat=10):
+    """Median wall time of a pysed run that has nothing to do: interpreter start, imports and argparse."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, PYSED, '-p', 'x', 'y'], stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def time_pysed(argv):
+    """Runs pysed.py in it's own process with the given arguments, output thrown away. Returns wall time in seconds."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, PYSED] + argv, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def compare_mmap(log_path, repeat=1):
+    """
+    Times the --mmap buffer search against the line loop for a few kinds of search. Prints a table and
+    returns the rows as (case, line loop seconds, mmap seconds).
+    """
+    cases = [
+        ('rare literal', ['-p', 'ERROR']),
+        ('anchored + group', ['-p', r'^(\S+ \S+) ERROR: .*']),
+        ('no literal', ['-p', r'\d{3}ms']),
+        ('line numbers', ['-l', '-p', 'WARNING']),
+    ]
+    size_mb = os.path.getsize(log_path) / 1024 ** 2
+    rows = []
+    print(f"{'case':<20}{'line loop':>12}{'mmap':>12}{'MB/s loop':>12}{'MB/s mmap':>12}{'speedup':>10}")
+    for name, argv in cases:
+        loop = min(time_pysed(argv + ['-f', log_path]) for _ in range(repeat))
+        mapped = min(time_pysed(argv + ['--mmap', '-f', log_path]) for _ in range(repeat))
+        rows.append((name, loop, mapped))
+        print(f"{name:<20}{loop:>11.2f}s{mapped:>11.2f}s{size_mb / loop:>12.1f}{size_mb / mapped:>12.1f}{loop / mapped:>9.1f}x")
+    return rows
+
+def compare_keywords(log_path, workdir, counts=(100, 1000, 5000), repeat=1, seed=0):
+    """
+    Times --keywords-file against the obvious way of doing the same thing, one big 'a|b|c|...' alternation
+    passed to -p, for searching and for redacting, with a few sizes of keyword list. The keywords are user
+    ids like the ones in the generated log, so some of them hit. Prints a table and returns the rows as 
+    (case, alternation seconds, keywords seconds).
+    """
+    rand = random.Random(seed)
+    keywords_path = os.path.join(workdir, 'pysed_benchmark_keywords.txt')
+    size_mb = os.path.getsize(log_path) / 1024 ** 2
+    rows = []
+    print(f"{'case':<24}{'alternation':>14}{'keywords':>12}{'MB/s alt':>12}{'MB/s kw':>12}{'speedup':>10}")
+    try:
+        for count in counts:
+            keywords = sorted({f'user:{rand.randint(1, 99999)}' for _ in range(count)})
+            with open(keywords_path, 'w') as keywords_file:
+                keywords_file.write('\n'.join(keywords) + '\n')
+            alternation = '|'.join(re.escape(keyword) for keyword in keywords)
+            for name, extra in [('search', []), ('redact', ['-s', '<redacted>'])]:
+                naive = min(time_pysed(['-p', alternation] + extra + ['-f', log_path]) for _ in range(repeat))
+                trie = min(time_pysed(['--keywords-file', keywords_path] + extra + ['-f', log_path]) for _ in range(repeat))
+                case = f'{name} {count} keywords'
+                rows.append((case, naive, trie))
+                print(f"{case:<24}{naive:>13.2f}s{trie:>11.2f}s{size_mb / naive:>12.1f}{size_mb / trie:>12.1f}{naive / trie:>9.1f}x")
+    finally:
+        if os.path.exists(keywords_path):
+            os.remove(keywords_path)
+    return rows
+
+def run_suite(sizes, workdir, repeat=1, config_repeat=5, env_count=5000):
+    """
+    Runs every case and returns the results as {case name: {metric: value}}. Metrics are seconds, MB/s
+    (for anything reading bytes), ops/s (for parsers) and peak RSS in MB. Runs are repeated and the
+    fastest kept; peak RSS is the largest seen.
+    """
+    def best(spec):
+        runs = [measure(spec) for _ in range(repeat)]
+        fastest = min(runs, key=lambda run: run['seconds'])
+        result = {'seconds': fastest['seconds'], 'rss_mb': max(run['rss_mb'] for run in runs)}
+        if 'bytes' in fastest:
+            result['mb_per_s'] = fastest['bytes'] / 1024 ** 2 / fastest['seconds']
+        if 'ops' in fastest:
+            result['ops_per_s'] = fastest['ops'] / fastest['seconds']
+        return result
+
+    results = {'pysed startup': {'seconds': startup_seconds()}}
+    for size in sizes:
+        log_path = os.path.join(workdir, f'pysed_benchmark_{size}.log')
+        print(f"Generating {size} log at {log_path}", file=sys.stderr)
+        generate_log(log_path, parse_size(size))
+        try:
+            for name, argv in PYSED_CASES:
+                results[f'pysed {name} {size}'] = best({'kind': 'pysed', 'argv': argv + ['-f', log_path]})
+        finally:
+            os.remove(log_path)
+
+    config_path = os.path.join(workdir, 'benchmark_config.json')
+    sub_keys = generate_json_config(config_path)
+    try:
+        json_spec = {'kind': 'json', 'path': config_path, 'repeat': config_repeat, 'cache': False}
+        results['json parse'] = best({**json_spec, 'sub_keys': []})
+        results['json parse sub_keys'] = best({**json_spec, 'sub_keys': sub_keys, 'stream': False})
+        results['json parse sub_keys streamed'] = best({**json_spec, 'sub_keys': sub_keys, 'stream': True})
+        results['json parse cached'] = best({**json_spec, 'sub_keys': sub_keys, 'cache': True, 'repeat': config_repeat * 40})
+    finally:
+        os.remove(config_path)
+    env_spec = {'kind': 'env', 'count': env_count, 'prefix': 'tdd_dev_db_', 'repeat': config_repeat * 40}
+    results['env parse_db2'] = best(env_spec)
+    results['env parse_db2 indexed'] = best({**env_spec, 'indexed': True})
+    return results
+
+def report(results, baseline=None):
+    """
+    Prints the results as a table. With a baseline (an earlier run's results), each number is followed by
+    it's change from the baseline in percent, so a regression shows up as a number rather than a feeling.
+    """
+    metrics = [('seconds', 's'), ('mb_per_s', 'MB/s'), ('ops_per_s', 'ops/s'), ('rss_mb', 'RSS MB')]
+    print(f"{'case':<28}" + ''.join(f'{label:>22}' for _, label in metrics))
+    for case, values in results.items():
+        row = f'{case:<28}'
+        for metric, _ in metrics:
+            if metric not in values:
+                row += f"{'-':>22}"
+                continue
+            cell = f'{values[metric]:.3f}'
+            previous = (baseline or {}).get(case, {}).get(metric)
+            if previous:
+                cell += f' ({(values[metric] - previous) / previous * 100:+.1f}%)'
+            row += f'{cell:>22}'
+        print(row)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks pysed and the ConfigParsers on generated data.")
+    parser.add_argument('--sizes', default='10M,100M', help="Comma separated log sizes to run the pysed cases on, ie 10M,1G.")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per case, the fastest is kept.")
+    parser.add_argument('--workdir', default=tempfile.gettempdir(), help="Where generated files go, they're removed afterwards.")
+    parser.add_argument('--save', metavar='BASELINE', help="Write the results to this JSON file to compare later runs against.")
+    parser.add_argument('--compare', metavar='BASELINE', help="Show each result's change from this saved baseline.")
+    parser.add_argument('--mmap', action='store_true', help="Only run the --mmap against line loop comparison.")
+    parser.add_argument('--keywords', action='store_true', help="Only run the --keywords-file against alternation regex comparison.")
+    parser.add_argument('-f', '--file', help="Existing log for the --mmap or --keywords comparison, instead of generating one.")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child))))
+    elif args.mmap or args.keywords:
+        compare = (lambda log_path: compare_mmap(log_path, args.repeat)) if args.mmap else (lambda log_path: compare_keywords(log_path, args.workdir, repeat=args.repeat))
+        if args.file:
+            compare(args.file)
+        else:
+            size = args.sizes.split(',')[-1]
+            log_path = os.path.join(args.workdir, f'pysed_benchmark_{size}.log')
+            print(f"Generating {size} log at {log_path}")
+            generate_log(log_path, parse_size(size))
+            try:
+                compare(log_path)
+            finally:
+                os.remove(log_path)
+    else:
+        baseline = None
+        if args.compare:
+            with open(args.compare) as baseline_file:
+                baseline = json.load(baseline_file)
+        results = run_suite(args.sizes.split(','), args.workdir, args.repeat)
+        report(results, baseline)
+        if args.save:
+            with open(args.save, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=4)
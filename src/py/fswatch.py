@@ -0,0 +1,136 @@
+# Python version: 3.8+
+# TLDR: Sleep until a file changes, using inotify when the OS has it and cheap stat polling when it doesn't
+# Why Should I use this?
+"""
+    * Polling a file in a tight loop burns CPU, polling it slowly means finding out late
+    * inotify tells you the moment something happens, but it's Linux only and not in the standard library
+"""
+# Changelog
+"""
+    * Created for pysed --follow
+"""
+# Frantic Scribbling on the Wall
+"""
+    inotify is reached through ctypes straight out of libc, no third party package needed. The PARENT
+    DIRECTORY of each file is watched rather than the file itself, that's the only way to hear about a log
+    being rotated (renamed away and a new one created in it's place) or a config being replaced by an
+    atomic rename. Events are filtered down to the names we actually care about.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+def _libc():
+    """libc with the inotify calls in it, or None on systems that don't have them."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch') else None
+
+def stat_signature(path):
+    """
+    (inode, size, mtime) for the file at path, or None if it's not there. Any change to the file, including
+    it being replaced by a different file of the same name, changes it.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+class Watcher(object):
+
+    def __init__(self, paths, interval=0.5, use_inotify=True):
+        """
+        Watches the files at paths. wait() blocks until one of them changes (written to, truncated, created,
+        deleted, renamed over) or the timeout runs out. Uses inotify where it's available and stat polling
+        every interval seconds everywhere else, which ever is in use is in self.mode.
+
+        A Watcher errs on the side of waking up: a wake up with nothing actually different costs a stat, a
+        missed change costs a stale read.
+        """
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.names = {os.fsencode(os.path.basename(path)) for path in self.paths}
+        self.interval = interval
+        self.fd = None
+        self.mode = 'poll'
+        self.signatures = {path: stat_signature(path) for path in self.paths}
+
+        libc = _libc() if use_inotify else None
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                for directory in {os.path.dirname(path) for path in self.paths}:
+                    if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+                        os.close(fd)
+                        break
+                else:
+                    self.fd = fd
+                    self.mode = 'inotify'
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a watched file changes or timeout seconds pass (None waits as long as it takes). Returns
+        True for a change, False for a timeout.
+        """
+        if self.fd is not None:
+            return self._wait_inotify(timeout)
+        return self._wait_poll(timeout)
+
+    def _wait_inotify(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            try:
+                events = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(events, offset)
+                name = events[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if name in self.names:
+                    return True
+
+    def _wait_poll(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for path in self.paths:
+                signature = stat_signature(path)
+                if signature != self.signatures[path]:
+                    self.signatures[path] = signature
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.interval if deadline is None else min(self.interval, max(deadline - time.monotonic(), 0)))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
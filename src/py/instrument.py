@@ -0,0 +1,454 @@
+# Python version: 3.8+
+# TLDR: Opt in timers and counters for Pysed and the ConfigParsers, exported as JSON or Prometheus text
+# Why Should I use this?
+"""
+    * Finding out if a slow run is the disk, the regex, the output or the JSON without guessing
+    * Costs nothing at all until it's switched on, so it never has to be ripped back out
+"""
+# Changelog
+"""
+    * Created for pysed --metrics and --profile
+"""
+# Frantic Scribbling on the Wall
+"""
+    Nothing in pysed.py or ConfigurationParser.py knows about this module. enable() swaps the hot methods
+    on the classes for timed versions of themselves and disable() puts the originals back, so while it's
+    off the code that runs is exactly the code that's written, not the same code plus an `if timing:` on
+    every line.
+
+    Stages are inclusive: 'pysed.infer' holds the whole run, 'pysed.read' and 'pysed.match' are parts of
+    it, and 'config.dsn' gets counted again inside 'config.validate_db2'. Only what happens in the process
+    that called enable() is counted. A --jobs worker gets the pipeline pickled without its timers (see
+    TimedRule), so lines matched in workers show up in 'pysed.infer' but not in the per line counts.
+"""
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+clock = time.perf_counter
+# Longest a pattern gets to be as a label. Keyword tries run to thousands of characters.
+LABEL_LENGTH = 200
+
+class Metrics(object):
+
+    def __init__(self):
+        """
+        Everything the timed methods record. One of these, `metrics`, is shared by the whole process, it's
+        what enable() hands back. Safe to record into from several threads at once.
+        * stages: name -> [calls, seconds, items]. items is what a generator stage yielded (lines read, ...)
+        * patterns: (kind, pattern) -> [calls, matches, seconds], kind being 'search' or 'substitute'
+        * counters: name -> running total, ie 'pysed.lines', 'pysed.bytes', 'pysed.matches'
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.patterns = {}
+            self.counters = {}
+
+    def add(self, stage, seconds, items=0, calls=1):
+        with self.lock:
+            record = self.stages.setdefault(stage, [0, 0.0, 0])
+            record[0] += calls
+            record[1] += seconds
+            record[2] += items
+
+    def merge(self, stages=(), patterns=(), counters=()):
+        """Adds in records kept somewhere else (see Tally), shaped like the ones here, all under one lock."""
+        with self.lock:
+            for name, (calls, seconds, items) in dict(stages).items():
+                record = self.stages.setdefault(name, [0, 0.0, 0])
+                record[0] += calls
+                record[1] += seconds
+                record[2] += items
+            for key, (calls, matches, seconds) in dict(patterns).items():
+                record = self.patterns.setdefault(key, [0, 0, 0.0])
+                record[0] += calls
+                record[1] += matches
+                record[2] += seconds
+            for name, value in dict(counters).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        """
+        Everything recorded as plain dictionaries and lists, with the rates worked out: items per second for
+        each stage, and for a Pysed run lines and bytes per second (over 'pysed.infer') and the share of
+        lines that matched.
+        """
+        with self.lock:
+            stages = {name: list(record) for name, record in self.stages.items()}
+            patterns = {key: list(record) for key, record in self.patterns.items()}
+            counters = dict(self.counters)
+        report = {'stages': {}, 'counters': counters, 'patterns': []}
+        for name, (calls, seconds, items) in sorted(stages.items()):
+            report['stages'][name] = {'calls': calls, 'seconds': seconds, 'items': items,
+                                      'items_per_second': items / seconds if seconds else 0.0}
+        for (kind, pattern), (calls, matches, seconds) in sorted(patterns.items(), key=lambda item: -item[1][2]):
+            report['patterns'].append({'kind': kind, 'pattern': pattern, 'calls': calls, 'matches': matches,
+                                       'seconds': seconds, 'match_rate': matches / calls if calls else 0.0})
+        if 'pysed.infer' in stages:
+            seconds = stages['pysed.infer'][1]
+            lines = counters.get('pysed.lines', 0)
+            report['rates'] = {
+                'lines_per_second': lines / seconds if seconds else 0.0,
+                'bytes_per_second': counters.get('pysed.bytes', 0) / seconds if seconds else 0.0,
+                'match_rate': counters.get('pysed.matches', 0) / lines if lines else 0.0,
+            }
+        return report
+
+    def to_json(self, indent=None):
+        return json.dumps(self.report(), indent=indent)
+
+    def prometheus(self, prefix='sack'):
+        """
+        The Prometheus text exposition format, ie for node_exporter's textfile collector. Only the running
+        totals go in, rates are left for whoever scrapes them to work out.
+        """
+        report = self.report()
+        lines = []
+        def family(name, kind, help_text, samples):
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{label}="{_escape(value)}"' for label, value in labels)
+                lines.append(f'{prefix}_{name}{{{label_text}}} {value}' if label_text else f'{prefix}_{name} {value}')
+        stages = report['stages']
+        family('stage_seconds_total', 'counter', 'Seconds spent in each stage.',
+               [((('stage', name),), record['seconds']) for name, record in stages.items()])
+        family('stage_calls_total', 'counter', 'Times each stage ran.',
+               [((('stage', name),), record['calls']) for name, record in stages.items()])
+        family('stage_items_total', 'counter', 'Items (lines, rows...) each stage produced.',
+               [((('stage', name),), record['items']) for name, record in stages.items()])
+        for name, value in sorted(report['counters'].items()):
+            family(name.replace('.', '_') + '_total', 'counter', f'Running total of {name}.', [((), value)])
+        patterns = report['patterns']
+        family('pattern_seconds_total', 'counter', 'Seconds spent running each pattern.',
+               [((('kind', record['kind']), ('pattern', record['pattern'])), record['seconds']) for record in patterns])
+        family('pattern_calls_total', 'counter', 'Lines each pattern was run on.',
+               [((('kind', record['kind']), ('pattern', record['pattern'])), record['calls']) for record in patterns])
+        family('pattern_matches_total', 'counter', 'Lines each pattern matched.',
+               [((('kind', record['kind']), ('pattern', record['pattern'])), record['matches']) for record in patterns])
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+metrics = Metrics()
+
+# (class, attribute name) -> the attribute as it was before enable() swapped it, for disable().
+_swapped = {}
+
+def timed(function, stage):
+    """function, recording how long each call takes under stage."""
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.add(stage, clock() - start)
+    return timed_function
+
+def timed_generator(function, stage):
+    """
+    function, which returns an iterator, recording the time spent getting each item out of it and how
+    many items there were under stage. Time the caller spends between items isn't counted.
+    """
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        iterator = iter(function(*args, **kwargs))
+        elapsed, items = 0.0, 0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += clock() - start
+                items += 1
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            metrics.add(stage, elapsed, items)
+    return timed_function
+
+class TimedStream(object):
+    """
+    Wraps an output stream, keeping the time spent in write and flush for 'pysed.write' until merge()
+    adds it to metrics. Everything else goes straight through to the stream, and it compares equal to 
+    the stream it wraps. Written to by one thread, infer's.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.writes, self.seconds, self.written = 0, 0.0, 0
+
+    def write(self, data):
+        start = clock()
+        try:
+            return self._stream.write(data)
+        finally:
+            self.seconds += clock() - start
+            self.writes += 1
+            self.written += len(data)
+
+    def flush(self):
+        start = clock()
+        try:
+            return self._stream.flush()
+        finally:
+            self.seconds += clock() - start
+
+    def merge(self):
+        metrics.add('pysed.write', self.seconds, self.written, self.writes)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __eq__(self, other):
+        return self._stream is other or self._stream == other
+
+    def __hash__(self):
+        return hash(self._stream)
+
+def _label(pattern):
+    label = os.fsdecode(pattern) if isinstance(pattern, bytes) else str(pattern)
+    return label if len(label) <= LABEL_LENGTH else label[:LABEL_LENGTH - 3] + '...'
+
+def _rule_pattern(pipeline, function, attribute):
+    """The pattern behind one of a RulePipeline's search or subn functions, for naming it."""
+    for rule in pipeline.rules:
+        if getattr(rule, attribute) is function:
+            return _label(rule.pattern)
+    owner = getattr(function, '__self__', None) # A fused alternation, or a rule's own regex.
+    return _label(getattr(owner, 'pattern', getattr(function, '__qualname__', function)))
+
+class Tally(threading.local):
+    """
+    What one infer run counts line by line, kept apart for each thread that's matching lines so no lock 
+    is ever taken per line. Every thread's records are listed in tallies, and merged into metrics once 
+    the run is over (see _instrument_pipeline), so the timings measure the patterns, not the counting.
+    """
+
+    def __init__(self, tallies):
+        self.match = [0, 0.0, 0]   # calls, seconds, items: the 'pysed.match' stage
+        self.lines = [0, 0, 0]     # lines, bytes, matches
+        self.patterns = {}         # (kind, pattern) -> [calls, matches, seconds]
+        tallies.append((self.match, self.lines, self.patterns))
+
+def _untimed(function):
+    return function
+
+class TimedRule(object):
+    """
+    One of a RulePipeline's search or subn functions, counting calls, matches and time into a Tally under
+    key, ie ('search', pattern). Pickles as the function it wraps, so a --jobs worker started by spawn or
+    forkserver gets the plain pipeline rather than a tally it couldn't report back from anyway.
+    """
+
+    def __init__(self, function, key, tally):
+        self.function, self.key, self.tally = function, key, tally
+
+    def record(self, elapsed, matched):
+        patterns = self.tally.patterns
+        record = patterns.get(self.key)
+        if record is None:
+            record = patterns[self.key] = [0, 0, 0.0]
+        record[0] += 1
+        if matched:
+            record[1] += 1
+        record[2] += elapsed
+
+    def __reduce__(self):
+        return _untimed, (self.function,)
+
+class TimedSearch(TimedRule):
+
+    def __call__(self, line):
+        start = clock()
+        match = self.function(line)
+        self.record(clock() - start, match)
+        return match
+
+class TimedSubn(TimedRule):
+
+    def __call__(self, substitute, line):
+        start = clock()
+        result = self.function(substitute, line)
+        self.record(clock() - start, result[1])
+        return result
+
+class TimedLine(TimedRule):
+    """
+    A RulePipeline's search or substitute, timed as 'pysed.match'. The one that runs first on every line
+    (counting) also counts the lines, bytes and matches. Pickles as the function it wraps, like TimedRule.
+    """
+
+    def __init__(self, function, tally, substitute, counting):
+        self.function, self.tally, self.substitute, self.counting = function, tally, substitute, counting
+
+    def __call__(self, line):
+        start = clock()
+        result = self.function(line)
+        elapsed = clock() - start
+        match = self.tally.match
+        match[0] += 1
+        match[1] += elapsed
+        match[2] += 1
+        if self.counting:
+            lines = self.tally.lines
+            lines[0] += 1
+            lines[1] += len(line)
+            if (result[1] if self.substitute else result is not None):
+                lines[2] += 1
+        return result
+
+def _instrument_pipeline(pipeline):
+    """
+    Swaps a RulePipeline's search and substitute functions for timed ones on the instance, per pattern and
+    as a whole ('pysed.match'), counting lines, bytes and matches along the way into a Tally. Returns a 
+    function that puts everything back and merges what was counted into metrics.
+    """
+    tallies = []
+    tally = Tally(tallies)
+    searches, substitutions = pipeline.searches, pipeline.substitutions
+    pipeline.searches = [TimedSearch(search, ('search', _rule_pattern(pipeline, search, 'search')), tally)
+                         for search in searches]
+    pipeline.substitutions = [(TimedSubn(subn, ('substitute', _rule_pattern(pipeline, subn, 'subn')), tally), substitute, literal)
+                              for subn, substitute, literal in substitutions]
+    # Lines are counted by whichever runs first on every line: search when there are search rules.
+    pipeline.search = TimedLine(pipeline.search, tally, False, bool(searches))
+    pipeline.substitute = TimedLine(pipeline.substitute, tally, True, not searches)
+    def restore():
+        pipeline.searches, pipeline.substitutions = searches, substitutions
+        del pipeline.search, pipeline.substitute
+        for match, lines, patterns in tallies:
+            metrics.merge(stages={'pysed.match': match} if match[0] else {}, patterns=patterns,
+                          counters={'pysed.lines': lines[0], 'pysed.bytes': lines[1], 'pysed.matches': lines[2]})
+    return restore
+
+def _timed_infer(infer):
+    """Pysed.infer, timed whole as 'pysed.infer' with it's pipeline and output instrumented for the run."""
+    @functools.wraps(infer)
+    def timed_infer(self, output=None):
+        if output is None:
+            output = sys.stdout
+        if (self.binary or self.compress) and isinstance(output, io.TextIOBase) and hasattr(output, 'buffer'):
+            # infer would swap to the binary buffer itself, but can't see through the wrapper to do it.
+            output.flush()
+            output = output.buffer
+        restore = _instrument_pipeline(self.pipeline)
+        stream = TimedStream(output)
+        start = clock()
+        try:
+            return infer(self, stream)
+        finally:
+            metrics.add('pysed.infer', clock() - start)
+            stream.merge()
+            restore()
+    return timed_infer
+
+# What enable() swaps, by class: attribute name -> (wrapper, stage).
+PYSED_HOT_PATHS = {
+    'Pysed': {
+        'infer': (_timed_infer, None),
+        'edit_in_place': (timed, 'pysed.edit_in_place'),
+        'aggregate': (timed, 'pysed.aggregate'),
+        '_input_lines': (timed_generator, 'pysed.read'),
+        '_buffer_lines': (timed_generator, 'pysed.mmap'),
+        'table_chunks': (timed_generator, 'pysed.table'),
+    },
+}
+CONFIG_HOT_PATHS = {
+    'ConfigParser': {
+        'validate_db2': (timed, 'config.validate_db2'),
+        'validate_database': (timed, 'config.validate_database'),
+        'dsn': (timed, 'config.dsn'),
+    },
+    'JsonConfigParser': {
+        'parse': (timed, 'config.json.parse'),
+        '_load_file': (timed, 'config.json.decode'),
+    },
+    'EnvConfigParser': {
+        'parse': (timed, 'config.env.parse'),
+        'parse_many': (timed, 'config.env.parse_many'),
+        'refresh': (timed, 'config.env.scan'),
+    },
+    'LayeredConfigParser': {
+        'parse': (timed, 'config.layered.parse'),
+        'reload': (timed, 'config.layered.reload'),
+    },
+}
+
+def _swap(cls, name, wrapper, stage):
+    if (cls, name) in _swapped or name not in vars(cls):
+        return
+    original = vars(cls)[name]
+    function = original.__func__ if isinstance(original, (classmethod, staticmethod)) else original
+    replacement = wrapper(function) if stage is None else wrapper(function, stage)
+    if isinstance(original, (classmethod, staticmethod)):
+        replacement = type(original)(replacement)
+    _swapped[(cls, name)] = original
+    setattr(cls, name, replacement)
+
+def enable(*modules):
+    """
+    Switches instrumentation on for the classes in modules (pysed and ConfigurationParser by default,
+    pass the module object itself when it's running as __main__) and returns the shared Metrics.
+    Calling it again for the same modules does nothing.
+        metrics = instrument.enable()
+        JsonConfigParser().parse_db2('config.json', ['db2'])
+        print(metrics.prometheus())
+    """
+    if not modules:
+        import ConfigurationParser
+        import pysed
+        modules = (pysed, ConfigurationParser)
+    for module in modules:
+        for hot_paths in (PYSED_HOT_PATHS, CONFIG_HOT_PATHS):
+            for class_name, methods in hot_paths.items():
+                cls = getattr(module, class_name, None)
+                if cls is None:
+                    continue
+                for name, (wrapper, stage) in methods.items():
+                    _swap(cls, name, wrapper, stage)
+    return metrics
+
+def disable():
+    """Puts back every method enable() swapped. What was recorded is kept, see Metrics.reset."""
+    for (cls, name), original in reversed(list(_swapped.items())):
+        setattr(cls, name, original)
+    _swapped.clear()
+
+def enabled():
+    return bool(_swapped)
+
+def profile(function, *args, path=None, limit=30, stream=None, **kwargs):
+    """
+    Runs function(*args, **kwargs) under cProfile and returns what it returns. With no path (or '-') the
+    limit slowest functions by cumulative time are printed to stream (stderr by default), otherwise the
+    raw profile is saved to path for pstats, snakeviz and the like.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        if path in (None, '-'):
+            pstats.Stats(profiler, stream=stream or sys.stderr).sort_stats('cumulative').print_stats(limit)
+        else:
+            profiler.dump_stats(path)
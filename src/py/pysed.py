@@ -19,11 +19,767 @@
 """
 import re
 import argparse
+import bz2
+import codecs
+import collections
+import concurrent.futures
+import functools
+import glob
+import gzip
+import io
+import json
+import lzma
+import mmap
+import operator
 import os
+import queue
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import warnings
+try: # The regex parser moved in 3.11, it's only used to find the literal text a pattern requires.
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Bytes read from the input file per disk read. Big logs are the whole point, so read big.
+READ_BUFFER_SIZE = 1024 * 1024
+# Bytes of file each --jobs worker gets at a time. Files smaller than this aren't worth a process pool.
+CHUNK_SIZE = 32 * 1024 * 1024
+# Seconds --follow sleeps between looks at the file when there's no inotify to wake it up sooner.
+FOLLOW_INTERVAL = 0.5
+# Output lines a --workers thread hands over at a time, and how many handovers can wait on a file before
+# it's reader stops and waits for the file to be written out. Caps the memory a file ahead in line can use.
+RESULT_BATCH_SIZE = 256
+RESULT_BATCHES = 16
+# Rows --table reads into memory at a time. Each chunk is searched and written before the next is read.
+TABLE_CHUNK_ROWS = 100000
+
+def warn(message):
+    """Warnings go to stderr, so they never end up mixed into results someone is piping somewhere."""
+    print(message, file=sys.stderr)
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern, flags=0):
+    """
+    Compiles a regex once and hands back the same compiled object every time after. re keeps its own cache,
+    but it's small and gets looked up on every re.search/re.sub call, so once a handful of patterns are in
+    play it starts thrashing. Anything that wants a pattern should come through here. 
+    
+    Bad patterns are reported the same way every other fatal Pysed problem is.
+    """
+    try:
+        return re.compile(pattern, flags)
+    except re.error as e:
+        raise Exception(f"FATAL: Regex pattern `{os.fsdecode(pattern)}` is not valid: {e}")
+
+# Letters allowed in a rule's flags, same letters as the inline (?imsxa) flags.
+RULE_FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE, 'a': re.ASCII}
+
+def parse_flags(flags):
+    """
+    Turns a rule's flags into an re flag value. Takes either a string of inline flag letters ('im') or a 
+    list of flag names (['IGNORECASE', 'MULTILINE']), which ever reads better in the rules file. 
+    """
+    if not flags:
+        return 0
+    value = 0
+    if isinstance(flags, str):
+        for letter in flags.lower():
+            if letter not in RULE_FLAGS:
+                raise Exception(f"FATAL: Unknown regex flag `{letter}`, use any of {''.join(RULE_FLAGS)}.")
+            value |= RULE_FLAGS[letter]
+    else:
+        for name in flags:
+            if not hasattr(re, str(name).upper()):
+                raise Exception(f"FATAL: Unknown regex flag `{name}`.")
+            value |= getattr(re, str(name).upper())
+    return value
+
+@functools.lru_cache(maxsize=256)
+def required_literal(pattern, flags=0):
+    """
+    Finds the longest run of plain text that every match of the pattern has to contain, ie 'ERROR' out of 
+    '^\\d+ ERROR: (.*)'. A line without that text can't match, and checking `literal in line` is far cheaper
+    than running the regex, so it's used to throw out lines early. Only text that's required at the top 
+    level of the pattern counts (groups included, alternations and repeats are not). Returns None when 
+    there's nothing usable, including any case insensitive pattern. Works the same on bytes patterns, 
+    giving back bytes.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    if parsed.state.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return None
+    
+    runs, run = [], []
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                run.append(av)
+            elif op is sre_parse.SUBPATTERN and not av[1] & sre_parse.SRE_FLAG_IGNORECASE:
+                walk(av[3])
+            else:
+                runs.append(run[:])
+                run.clear()
+    walk(parsed)
+    runs.append(run)
+    longest = max(runs, key=len)
+    if not longest:
+        return None
+    return bytes(longest) if isinstance(pattern, bytes) else ''.join(map(chr, longest))
+
+@functools.lru_cache(maxsize=256)
+def byte_safe(pattern, flags=0):
+    """
+    True when running the (text) pattern over the encoded bytes of a line can't miss a match it would
+    find in the decoded line. Bytes regex only know ASCII: \\w, \\d, \\s and \\b, ignore case, . and 
+    negated classes all work on single bytes there, not characters, so any of those rule it out unless
+    the pattern is ASCII only to begin with (the `a` flag). So do lookbehinds, negative lookaheads and 
+    non ASCII text. What's left is plain ASCII text, ASCII classes and ranges, anchors, groups, 
+    alternations and repeats of those.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return False
+    ascii_only = bool(parsed.state.flags & sre_parse.SRE_FLAG_ASCII)
+    if parsed.state.flags & sre_parse.SRE_FLAG_IGNORECASE and not ascii_only:
+        return False
+    repeats = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)}
+    boundaries = {sre_parse.AT_BOUNDARY, sre_parse.AT_NON_BOUNDARY}
+    
+    def safe(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                if av > 127:
+                    return False
+            elif op is sre_parse.IN:
+                for class_op, class_av in av:
+                    if class_op is sre_parse.LITERAL and class_av > 127:
+                        return False
+                    if class_op is sre_parse.RANGE and class_av[1] > 127:
+                        return False
+                    if class_op is sre_parse.NEGATE or (class_op is sre_parse.CATEGORY and not ascii_only):
+                        return False
+            elif op is sre_parse.AT:
+                if av in boundaries and not ascii_only:
+                    return False
+            elif op is sre_parse.SUBPATTERN:
+                if av[1] & sre_parse.SRE_FLAG_IGNORECASE and not ascii_only or not safe(av[3]):
+                    return False
+            elif op is sre_parse.BRANCH:
+                if not all(safe(branch) for branch in av[1]):
+                    return False
+            elif op in repeats:
+                if not safe(av[2]):
+                    return False
+            elif op is sre_parse.ASSERT:
+                if av[0] < 0 or not safe(av[1]):
+                    return False
+            elif op is sre_parse.GROUPREF:
+                continue
+            else: # ., \\w and friends outside a class, negative lookarounds, conditionals...
+                return False
+        return True
+    return safe(parsed)
+
+@functools.lru_cache(maxsize=256)
+def ends_line(pattern, flags=0):
+    """
+    True when the pattern uses $ anywhere, or can't be parsed. $ only matches before a \n, so over the 
+    raw bytes of a file with \r\n line endings it misses the ends of lines that the text line loop 
+    (which reads them back as \n) would match.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return True
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.AT and av is sre_parse.AT_END:
+                return True
+            for value in (av if isinstance(av, (tuple, list)) else ()):
+                values = value if isinstance(value, list) else [value]
+                if any(isinstance(item, sre_parse.SubPattern) and walk(item) for item in values):
+                    return True
+        return False
+    return walk(parsed)
+
+@functools.lru_cache(maxsize=256)
+def crosses_lines(pattern, flags=0):
+    """
+    True when the pattern can match the empty string, a \\n or a \\r, or can't be parsed. Over a whole
+    buffer a match like that can run into the next line (or sit between them), where the line loop
+    only ever sees one line at a time, ending in a plain \\n. That covers \\s, \\W, \\D, negated classes,
+    a literal \\n or \\r, and . with the `s` flag. A plain . can match a \\r, but only inside the line
+    it started in, which just makes an extra candidate.
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return True
+    if parsed.getwidth()[0] == 0:
+        return True
+    newlines = (ord('\n'), ord('\r'))
+    categories = {sre_parse.CATEGORY_SPACE, sre_parse.CATEGORY_NOT_DIGIT, sre_parse.CATEGORY_NOT_WORD,
+                  sre_parse.CATEGORY_LINEBREAK}
+    def matches_newline(op, av, dotall):
+        if op is sre_parse.LITERAL:
+            return av in newlines
+        if op is sre_parse.NOT_LITERAL or op is sre_parse.NEGATE:
+            return True
+        if op is sre_parse.RANGE:
+            return any(av[0] <= newline <= av[1] for newline in newlines)
+        if op is sre_parse.CATEGORY:
+            return av in categories
+        if op is sre_parse.IN:
+            return any(matches_newline(class_op, class_av, dotall) for class_op, class_av in av)
+        return op is sre_parse.ANY and dotall
+    def walk(items, dotall):
+        for op, av in items:
+            if op is sre_parse.SUBPATTERN:
+                if walk(av[3], (dotall or av[1] & sre_parse.SRE_FLAG_DOTALL) and not av[2] & sre_parse.SRE_FLAG_DOTALL):
+                    return True
+                continue
+            if matches_newline(op, av, dotall):
+                return True
+            for value in (av if isinstance(av, (tuple, list)) else ()):
+                values = value if isinstance(value, list) else [value]
+                if any(isinstance(item, sre_parse.SubPattern) and walk(item, dotall) for item in values):
+                    return True
+        return False
+    return walk(parsed, bool(parsed.state.flags & sre_parse.SRE_FLAG_DOTALL))
+
+@functools.lru_cache(maxsize=None)
+def splits_on_newline(encoding):
+    """
+    True when the encoding writes a \n as the single byte \n, with no byte order mark in front. Only then 
+    can the raw bytes of a file be cut into lines (or chunks) at \n bytes and each piece decoded on it's own,
+    which is what --mmap, --jobs and --follow do. UTF-8 and the ASCII based single byte encodings do, 
+    UTF-16 and UTF-32 don't.
+    """
+    return '\n'.encode(encoding) == b'\n'
+
+@functools.lru_cache(maxsize=256)
+def exact_literal(pattern, flags=0):
+    """
+    Finds patterns that are nothing but plain text, optionally anchored to the start of the line: 'ERROR', 
+    '^ERROR', 'user\\.name'. Those don't need the regex engine at all, `in` and startswith give the same 
+    answer faster. Returns (text, anchored), or None for anything that's actually a regex, including any 
+    case insensitive or MULTILINE pattern (where ^ means more than the start of the line). 
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    if parsed.state.flags & (sre_parse.SRE_FLAG_IGNORECASE | sre_parse.SRE_FLAG_MULTILINE):
+        return None
+    items = list(parsed)
+    anchored = bool(items) and items[0][0] is sre_parse.AT and items[0][1] in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING)
+    if anchored:
+        items = items[1:]
+    if not items or any(op is not sre_parse.LITERAL for op, av in items):
+        return None
+    values = [av for op, av in items]
+    return (bytes(values) if isinstance(pattern, bytes) else ''.join(map(chr, values))), anchored
+
+def trie_pattern(keywords):
+    """
+    Builds one regex matching any of the keywords, written as a trie: ['foobar', 'foobaz', 'food'] becomes
+    'foo(?:ba[rz]|d)'. re tries the branches of an alternation one after the other at every position, so
+    a plain 'foobar|foobaz|food' with thousands of keywords does thousands of tries per character. Shared
+    prefixes are only ever tried once in the trie, and it finds the longest keyword at each spot, same as 
+    sorting the alternation longest first would. Works on str or bytes keywords, giving back the same type.
+    """
+    binary = isinstance(keywords[0], bytes)
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        # Bytes go through as latin-1 text, one character per byte, and back again at the end.
+        for char in (keyword.decode('latin-1') if binary else keyword):
+            node = node.setdefault(char, {})
+        node[''] = {}
+    
+    def build(node):
+        optional = '' in node
+        singles, branches = [], []
+        for char in sorted(char for char in node if char):
+            tail = build(node[char])
+            if tail:
+                branches.append(re.escape(char) + tail)
+            else:
+                singles.append(re.escape(char))
+        if len(singles) > 1:
+            branches.append('[' + ''.join(singles) + ']')
+        else:
+            branches.extend(singles)
+        if not branches:
+            return ''
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')' + ('?' if optional else '')
+    pattern = build(trie)
+    return pattern.encode('latin-1') if binary else pattern
+
+def load_keywords(path, binary=False, encoding=None):
+    """Reads a --keywords-file, one keyword per line. Blank lines are skipped, everything else is taken as is."""
+    try:
+        with open(path, 'rb') as keywords_file:
+            lines = keywords_file.read().splitlines()
+    except OSError as e:
+        raise Exception(f"FATAL: Keywords file `{path}` can't be read: {e}")
+    keywords = sorted({line for line in lines if line})
+    if not binary:
+        keywords = [keyword.decode(encoding) for keyword in keywords]
+    if not keywords:
+        raise Exception(f"FATAL: Keywords file `{path}` has no keywords in it.")
+    return keywords
+
+def _ahocorasick():
+    """pyahocorasick, which --keywords-file uses when it's installed. It's optional, the trie regex works without it."""
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    return ahocorasick
+
+def load_rules(path, binary=False):
+    """
+    Loads an ordered list of rules from a JSON file (or YAML, if PyYAML is installed and the file ends in 
+    .yml/.yaml). Each rule is either an object or a short list:
+        [
+            {"pattern": "^DEBUG"},
+            {"pattern": "password=\\S+", "substitute": "password=***", "flags": "i"},
+            ["(\\d{3})-\\d{4}", "\\g<1>-XXXX"]
+        ]
+    See RulePipeline for how the rules get applied.
+    """
+    if not os.path.isfile(path):
+        raise Exception(f"FATAL: rules file {path} not a valid path.")
+    with open(path) as rules_file:
+        if path.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise Exception("FATAL: PyYAML is needed to read a YAML rules file, use JSON or pip install pyyaml.")
+            rules = yaml.safe_load(rules_file)
+        else:
+            try:
+                rules = json.load(rules_file)
+            except ValueError:
+                raise Exception(f"FATAL: rules file {path} was unable to be read as JSON.")
+    
+    if not isinstance(rules, list):
+        raise Exception(f"FATAL: rules file {path} should hold a list of rules.")
+    loaded = []
+    for rule in rules:
+        if isinstance(rule, str):
+            rule = {'pattern': rule}
+        elif isinstance(rule, list):
+            rule = dict(zip(('pattern', 'substitute', 'flags'), rule))
+        if not isinstance(rule, dict) or not rule.get('pattern'):
+            raise Exception(f"FATAL: rule {rule} in {path} has no pattern.")
+        loaded.append(PysedRule(rule['pattern'], rule.get('substitute'), rule.get('flags'), binary))
+    return loaded
+
+def count_newlines(buffer, start, end, chunk_size=16 * 1024 * 1024):
+    """
+    Counts the newlines in buffer[start:end]. mmap has no count method, so it's done a slice at a time, 
+    which keeps the copying bounded no matter how far apart start and end are.
+    """
+    newlines = 0
+    for offset in range(start, end, chunk_size):
+        newlines += buffer[offset:min(offset + chunk_size, end)].count(b'\n')
+    return newlines
+
+# Leading bytes of each compressed format pysed can read, and the name --compress knows it by.
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+]
+
+def detect_compression(path):
+    """Returns the compression the file at path uses going off it's first few bytes ('gz', 'bz2', 'xz', 'zst'), or None."""
+    with open(path, 'rb') as input_file:
+        head = input_file.read(6)
+    for magic, kind in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("FATAL: The zstandard package is needed for .zst files, pip install zstandard.")
+    return zstandard
+
+def _pandas():
+    try:
+        import pandas
+    except ImportError:
+        pandas = None
+    # 1.5 is the first to take to_csv(lineterminator=...), see _write_table.
+    if pandas is None or tuple(int(part) for part in re.findall(r'\d+', pandas.__version__)[:2]) < (1, 5):
+        raise Exception("FATAL: pandas 1.5 or newer is needed for --table, pip install 'pandas>=1.5'.")
+    return pandas
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("FATAL: pyarrow is needed to write --parquet output, pip install pyarrow.")
+    return pyarrow
+
+def open_input(path, encoding=None, errors=None, newline=None):
+    """
+    Opens a file for reading, decompressing it on the fly if it's gzip, bz2, xz or zstd (zstd needs the 
+    zstandard package). Compression is found from the file's magic bytes, not it's name. The decompressor 
+    is read through a READ_BUFFER_SIZE buffer so it works in big blocks, and nothing is ever decompressed 
+    to disk or held whole in memory. 
+    
+    Without an encoding the file is read as raw bytes. With one, it's decoded as text and errors and 
+    newline work like they do for open().
+    """
+    kind = detect_compression(path)
+    if kind is None:
+        if encoding is None:
+            return open(path, 'rb', buffering=READ_BUFFER_SIZE)
+        return open(path, buffering=READ_BUFFER_SIZE, encoding=encoding, errors=errors, newline=newline)
+    if kind == 'gz':
+        raw = gzip.GzipFile(path, 'rb')
+    elif kind == 'bz2':
+        raw = bz2.BZ2File(path, 'rb')
+    elif kind == 'xz':
+        raw = lzma.LZMAFile(path, 'rb')
+    else:
+        raw = _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    binary = io.BufferedReader(raw, buffer_size=READ_BUFFER_SIZE)
+    if encoding is None:
+        return binary
+    return io.TextIOWrapper(binary, encoding=encoding, errors=errors, newline=newline)
+
+def compressed_writer(binary, kind):
+    """
+    Wraps a binary stream (ie sys.stdout.buffer) in a compressor for --compress. Closing what comes back
+    finishes the compressed stream without closing the stream underneath it.
+    """
+    if kind == 'gz':
+        return gzip.GzipFile(fileobj=binary, mode='wb')
+    if kind == 'bz2':
+        return bz2.BZ2File(binary, 'wb')
+    if kind == 'xz':
+        return lzma.LZMAFile(binary, 'wb')
+    if kind == 'zst':
+        return _zstandard().ZstdCompressor().stream_writer(binary, closefd=False)
+    raise Exception(f"FATAL: Unknown compression `{kind}`, use one of gz, bz2, xz or zst.")
+
+def expand_paths(paths, recursive=False):
+    """
+    Turns what was given to -f into a list of files. Each entry can be a file, a directory (the files
+    directly in it, or everything under it with recursive) or a glob ('logs/*.log', 'logs/**/*.gz' when
+    recursive). Files come back in the order they were asked for, with directories and globs sorted 
+    and duplicates dropped, so the output order never depends on the filesystem.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+        elif os.path.isdir(path):
+            if recursive:
+                found = [os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names]
+            else:
+                found = [entry.path for entry in os.scandir(path) if entry.is_file()]
+            files.extend(sorted(found))
+        elif glob.has_magic(path):
+            found = sorted(match for match in glob.glob(path, recursive=recursive) if os.path.isfile(match))
+            if not found:
+                warn(f"WARN: {path} didn't match any files.")
+            files.extend(found)
+        else:
+            raise Exception(f"FATAL: file argument {path} not a valid path.")
+    if not files:
+        raise Exception("FATAL: No files found to search through.")
+    return list(dict.fromkeys(files))
+
+def chunk_ranges(path, chunk_size):
+    """Splits a file into (start, end) byte ranges of about chunk_size, each ending just after a newline."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as input_file:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                input_file.seek(end)
+                input_file.readline()
+                end = input_file.tell()
+            else:
+                end = size
+            yield start, end
+            start = end
+
+def number_text(line_no, line):
+    return f'{line_no}: {line}'
+
+def number_bytes(line_no, line):
+    return b'%d: %s' % (line_no, line)
+
+def number_context_text(line_no, line):
+    return f'{line_no}- {line}'
+
+def number_context_bytes(line_no, line):
+    return b'%d- %s' % (line_no, line)
+
+def renumber(results, line_offset, number_line=number_text):
+    """Yields a chunk's results, turning (chunk line number, line) pairs into real 'line_no: line' output."""
+    for result in results:
+        if type(result) is tuple:
+            yield number_line(result[0] + line_offset, result[1])
+        else:
+            yield result
+
+# Each --jobs worker process gets it's own copy of the Pysed doing the work, set up once by _init_worker.
+_worker_pysed = None
+
+def _init_worker(pysed):
+    global _worker_pysed
+    _worker_pysed = pysed
+
+def _chunk_worker(path, start, end):
+    return _worker_pysed._chunk_results(path, start, end)
+
+def _edit_worker(path):
+    return _worker_pysed._edit_in_place(path)
+
+def _tally_worker(path, start, end):
+    return _worker_pysed._tally(enumerate(_worker_pysed._chunk_input(path, start, end), 1), path)
+
+class LiteralMatch(object):
+    """
+    What a search that didn't use the regex engine (a plain text rule, or keywords) hands back instead of a 
+    re.Match. It has just the parts of a match Pysed looks at: the text matched, and no groups.
+    """
+    __slots__ = ('re', 'text')
+    
+    def __init__(self, regex, text):
+        self.re = regex
+        self.text = text
+    
+    def group(self, *indices):
+        return self.text
+    
+    def groups(self, default=None):
+        return ()
+
+class LiteralText(object):
+    """
+    search and subn for a pattern that's plain text, done with `in`/startswith and str.replace rather than 
+    the regex engine (see PysedRule). A class rather than closures so a Pysed can be pickled over to --jobs
+    worker processes.
+    """
+    
+    def __init__(self, regex, text, anchored):
+        self.text = text
+        self.anchored = anchored
+        self.hit = LiteralMatch(regex, text)
+    
+    def search(self, line):
+        if (line.startswith(self.text) if self.anchored else self.text in line):
+            return self.hit
+        return None
+    
+    def subn(self, substitute, line):
+        text = self.text
+        if self.anchored:
+            if line.startswith(text):
+                return substitute + line[len(text):], 1
+            return line, 0
+        count = line.count(text)
+        if count:
+            return line.replace(text, substitute), count
+        return line, 0
+
+class KeywordAutomaton(object):
+    """
+    search and subn for a --keywords-file rule, done by a pyahocorasick automaton (see PysedRule.from_keywords).
+    Automatons don't pickle everywhere, so a pickled one is rebuilt from it's keywords on the other side.
+    """
+    
+    def __init__(self, regex, keywords):
+        self.regex = regex
+        self.keywords = keywords
+        self.automaton = _ahocorasick().Automaton()
+        for keyword in keywords:
+            self.automaton.add_word(keyword, keyword)
+        self.automaton.make_automaton()
+    
+    def __reduce__(self):
+        return (KeywordAutomaton, (self.regex, self.keywords))
+    
+    def search(self, line):
+        for end, keyword in self.automaton.iter_long(line):
+            return LiteralMatch(self.regex, keyword)
+        return None
+    
+    def subn(self, substitute, line):
+        parts, start = [], 0
+        for end, keyword in self.automaton.iter_long(line):
+            parts.append(line[start:end + 1 - len(keyword)])
+            parts.append(substitute)
+            start = end + 1
+        if not parts:
+            return line, 0
+        parts.append(line[start:])
+        return ''.join(parts), len(parts) // 2
+
+class PysedRule(object):
+    
+    def __init__(self, pattern, substitute=None, flags=None, binary=False):
+        """
+        One pattern, it's optional substitute and flags, compiled. A rule without a substitute is a search
+        rule, with one it's a substitute rule. literal is the text any match requires (see required_literal).
+        
+        binary rules match bytes rather than text, the pattern and substitute are turned into bytes the 
+        same way the command line they came from would have been (os.fsencode).
+        
+        search and subn are what the rule is run with, the compiled regex's own unless the pattern turns 
+        out to be plain text (see exact_literal), then it's `in`/startswith and str.replace instead. Only 
+        fusable rules get joined into an alternation with others, see RulePipeline, and only with rules
+        compiled with the same flags.
+        """
+        if binary:
+            pattern = os.fsencode(pattern) if isinstance(pattern, str) else pattern
+            substitute = os.fsencode(substitute) if isinstance(substitute, str) else substitute
+        self.pattern = pattern
+        self.substitute = substitute
+        self.flags = parse_flags(flags)
+        self.regex = compile_pattern(pattern, self.flags)
+        self.literal = required_literal(pattern, self.flags)
+        self.search = self.regex.search
+        self.subn = self.regex.subn
+        # A pattern setting it's own flags inline ((?i)...) would set them for the whole alternation it's
+        # fused into, before 3.11 without so much as an error, so it's run on it's own.
+        self.fusable = self.regex.flags == compile_pattern(pattern[:0], self.flags).flags
+        
+        exact = exact_literal(pattern, self.flags)
+        if exact is not None:
+            self._literal_fast_path(*exact)
+    
+    def _literal_fast_path(self, text, anchored):
+        """Swaps search (and subn, when the substitute has no backreferences to expand) for plain string methods."""
+        literal = LiteralText(self.regex, text, anchored)
+        self.search = literal.search
+        self.fusable = False
+        
+        backslash = b'\\' if isinstance(text, bytes) else '\\'
+        if self.substitute is None or backslash in self.substitute:
+            return
+        self.subn = literal.subn
+    
+    @classmethod
+    def from_keywords(cls, keywords, substitute=None, binary=False):
+        """
+        One rule matching any of a list of plain text keywords, for --keywords-file. It's a trie regex (see 
+        trie_pattern) so it runs anywhere a regex rule would, including --mmap. On text, when pyahocorasick
+        is installed the matching is done by an Aho-Corasick automaton instead, which finds every keyword 
+        in one pass over the line no matter how many there are. Either way the longest keyword wins when 
+        several start at the same spot, and the substitute replaces each hit.
+        """
+        rule = cls(trie_pattern(keywords), substitute, binary=binary)
+        rule.fusable = False
+        ahocorasick = None if binary else _ahocorasick()
+        if ahocorasick is None:
+            return rule
+        
+        matcher = KeywordAutomaton(rule.regex, keywords)
+        rule.search = matcher.search
+        if substitute is None or '\\' in substitute:
+            return rule
+        rule.subn = matcher.subn
+        return rule
+
+class RulePipeline(object):
+    
+    def __init__(self, rules):
+        """
+        Runs any number of rules over a line in one go, so a file gets read once no matter how many regex
+        need to be run against it. Rules work like chaining `grep -e .. -e ..` into `sed -e .. -e ..`:
+        * Search rules filter. A line is kept if ANY search rule matches the line as read. With no search
+          rules, every line is kept.
+        * Substitute rules then rewrite the kept lines, in the order they were given.
+        A single -p/-s is just a pipeline with one rule in it.
+        
+        Search rules with no groups only need a yes/no answer, so rules sharing the same flags are fused 
+        into one alternation and the line is scanned once for all of them. Rules with groups are kept apart 
+        (their groups are the output) and checked first, in order, then plain text and keyword rules, which
+        don't go through re at all (see PysedRule). If every search rule requires some plain
+        text, lines containing none of it are dropped without running a regex at all. Substitute rules skip
+        the same way, one at a time. 
+        """
+        self.rules = rules
+        search_rules = [rule for rule in rules if rule.substitute is None]
+        
+        self.searches = [rule.search for rule in search_rules if rule.regex.groups]
+        self.searches.extend(rule.search for rule in search_rules if not rule.regex.groups and not rule.fusable)
+        by_flags = {}
+        for rule in search_rules:
+            if not rule.regex.groups and rule.fusable:
+                by_flags.setdefault(rule.regex.flags, []).append(rule)
+        for flags, fusable in by_flags.items():
+            if len(fusable) == 1:
+                self.searches.append(fusable[0].regex.search)
+                continue
+            try:
+                bar, open_group, close_group = (b'|', b'(?:', b')') if isinstance(fusable[0].pattern, bytes) else ('|', '(?:', ')')
+                fused = compile_pattern(bar.join(open_group + rule.pattern + close_group for rule in fusable), flags)
+                self.searches.append(fused.search)
+            except Exception: # Anything else that won't survive being fused, run them apart.
+                self.searches.extend(rule.regex.search for rule in fusable)
+        
+        literals = [rule.literal for rule in search_rules]
+        self.prefilter = tuple(set(literals)) if search_rules and None not in literals else None
+        
+        self.substitutions = [(rule.subn, rule.substitute, rule.literal) for rule in rules if rule.substitute is not None]
+    
+    def search(self, line):
+        """Returns the match from the first search rule that matches the line, or None."""
+        if self.prefilter is not None:
+            for literal in self.prefilter:
+                if literal in line:
+                    break
+            else:
+                return None
+        for search in self.searches:
+            match = search(line)
+            if match:
+                return match
+        return None
+    
+    def substitute(self, line):
+        """Applies every substitute rule to the line in order, returns the new line and the number of replacements."""
+        total = 0
+        for subn, substitute, literal in self.substitutions:
+            if literal is not None and literal not in line:
+                continue
+            new_line, count = subn(substitute, line)
+            if count:
+                line = new_line
+                total += count
+        return line, total
 
 class Pysed(object):
 
-    def __init__(self, arguments):
+    def __init__(self, arguments=None, **options):
         """
         Initializes off of command line arguments. The arguments are defined under the class, just before Main. 
         Argparse could make Pattern manditory by making it a positional arg, HOWEVER it's left as an actually
@@ -32,35 +788,171 @@ class Pysed(object):
         
         Takes file input over command line input. Any argument passed that's not prefixed with a flag gets used
         as the input string to run the pattern over. 
+        
+        To use Pysed as a library, skip argparse and pass the options by their long names instead, anything
+        not given takes the command line default. text and file can be a single string or a list:
+            for line in Pysed(pattern='^WARNING: (.*)', file='app.log', encoding='utf-8').stream():
+                ...
+        Leave encoding out and the lines are bytes. from_argv takes a command line style list instead.
         """
-        self.parsed_args = {}
+        if arguments is None:
+            arguments = parser.parse_args([])
+        if options:
+            arguments = argparse.Namespace(**{**vars(arguments), **options})
+            if isinstance(arguments.text, str):
+                arguments.text = [arguments.text]
+        if arguments.table and arguments.encoding is None:
+            # pandas only does text, so --table decodes even when no encoding was asked for.
+            arguments = argparse.Namespace(**{**vars(arguments), 'encoding': 'utf-8'})
+        self.parsed_args = vars(arguments)
         
+        # No encoding means bytes in, bytes out: nothing is decoded, nothing is re-encoded, and lines that 
+        # aren't valid in any one encoding go through untouched. Patterns are matched as bytes too.
+        self.encoding = arguments.encoding
+        self.errors = arguments.errors
+        self.binary = self.encoding is None
+        if not self.binary:
+            try:
+                codecs.lookup(self.encoding)
+            except LookupError:
+                raise Exception(f"FATAL: Unknown --encoding `{self.encoding}`.")
+        # Whether the file's bytes can be cut up at \n bytes, see splits_on_newline.
+        self.byte_lines = self.binary or splits_on_newline(self.encoding)
+        self.newline = b'\n' if self.binary else '\n'
+        # What's kept of each line for output, the whole line (minus it's newline) unless --strip.
+        self._body = operator.methodcaller('strip') if arguments.strip else operator.methodcaller('rstrip', self.newline)
+        self._number_line = number_bytes if self.binary else number_text
+        
+        rules = []
         if arguments.pattern:
             self.pattern = arguments.pattern
-        else:
-            raise Exception("FATAL: Regex cannot be performed without a regex pattern, use the -p flag.")
+            rules.append(PysedRule(self.pattern, arguments.substitute or None, binary=self.binary))
+            # Compiled before any input is touched, so a bad pattern fails fast. Exposed for reuse.
+            self.regex = rules[0].regex
+        if arguments.rules:
+            rules.extend(load_rules(arguments.rules, self.binary))
+        if arguments.keywords_file:
+            keywords = load_keywords(arguments.keywords_file, self.binary, self.encoding)
+            rules.append(PysedRule.from_keywords(keywords, arguments.substitute or None, self.binary))
+        if not rules:
+            raise Exception("FATAL: Regex cannot be performed without a regex pattern, use the -p flag, a -r rules file or --keywords-file.")
+        self.pipeline = RulePipeline(rules)
         
         if arguments.substitute:
             self.substitute = arguments.substitute
 
         self.line_numbers = arguments.linenumbers
             
+        self.files = []
         if arguments.file and arguments.text:
-            print("WARN: Both -f and command line text provided, taking file by default.")
-            if not os.path.isfile(arguments.file):
-                raise Exception("FATAL: file argument not a valid path.")
-            self.file = arguments.file
+            warn("WARN: Both -f and command line text provided, taking file by default.")
+            self.files = expand_paths(arguments.file, arguments.recursive)
         elif arguments.text:
             self.text = ' '.join(arguments.text)
+            if self.binary:
+                self.text = os.fsencode(self.text)
         elif arguments.file:
-            if not os.path.isfile(arguments.file):
-                raise Exception("FATAL: file argument not a valid path.")
-            self.file = arguments.file
+            self.files = expand_paths(arguments.file, arguments.recursive)
         else:
             raise Exception("FATAL: Need text to search through, use -f or -t")
+        self.with_filename = arguments.with_filename
+        
+        self.in_place = arguments.in_place
+        if self.in_place:
+            if not self.files:
+                raise Exception("FATAL: --in-place needs files to rewrite, use -f.")
+            if self.pipeline.searches or not self.pipeline.substitutions:
+                raise Exception("FATAL: --in-place only works with substitute rules, use -s or rules with a substitute.")
+            if arguments.compress:
+                warn("WARN: --in-place keeps each file's own compression, ignoring --compress.")
+        self.compress = arguments.compress
+        self.jobs = max(arguments.jobs, 1)
+        if self.jobs > 1 and not self.byte_lines:
+            warn(f"WARN: --jobs cuts files at \\n bytes, which {self.encoding} doesn't have. Ignoring --jobs.")
+            self.jobs = 1
+        self.workers = max(arguments.workers, 1)
+        self.buffer_finder = None
+        if arguments.mmap:
+            if self.pipeline.substitutions:
+                raise Exception("FATAL: --mmap only works for searching, substitute rules need every line.")
+            if self.files and not self.byte_lines:
+                warn(f"WARN: --mmap finds lines by their \\n bytes, which {self.encoding} doesn't have. Reading line by line.")
+            elif self.files:
+                self.buffer_finder = self._buffer_finder()
+                if self.buffer_finder is None:
+                    warn("WARN: Patterns can't be run over the whole file buffer, falling back to reading line by line.")
+        
+        self.follow = arguments.follow
+        if self.follow:
+            if len(self.files) != 1:
+                raise Exception("FATAL: --follow watches exactly one file, use -f with a single file.")
+            if self.in_place:
+                raise Exception("FATAL: --follow and --in-place don't mix, a file that's still growing can't be rewritten.")
+            if detect_compression(self.files[0]):
+                raise Exception("FATAL: --follow can't follow a compressed file, there's no reading the end of one as it grows.")
+            if not self.byte_lines:
+                raise Exception(f"FATAL: --follow reads lines by their \\n bytes, which {self.encoding} doesn't have. Convert the log to UTF-8.")
+            if self.jobs > 1 or self.buffer_finder is not None:
+                warn("WARN: --follow reads the file line by line, ignoring --jobs and --mmap.")
+        
+        # grep style context around search matches, and multi line records. See _context_matches and _records.
+        self.before = arguments.before_context if arguments.before_context is not None else max(arguments.context, 0)
+        self.after = arguments.after_context if arguments.after_context is not None else max(arguments.context, 0)
+        if (self.before or self.after) and not self.pipeline.searches:
+            warn("WARN: Context lines are for searching, every line is output with substitute rules. Ignoring -A/-B/-C.")
+            self.before = self.after = 0
+        self._number_context = number_context_bytes if self.binary else number_context_text
+        self.record_start = None
+        if arguments.record_start:
+            if self.in_place:
+                raise Exception("FATAL: --in-place rewrites line by line, it can't be used with --record-start.")
+            self.record_start = compile_pattern(os.fsencode(arguments.record_start) if self.binary else arguments.record_start)
+            self.record_lines = max(arguments.record_lines, 1)
+        if self.before or self.after or self.record_start is not None:
+            # Both need every line, in order. A chunk doesn't know what came before it, and --mmap skips lines.
+            if self.jobs > 1 or self.buffer_finder is not None:
+                warn("WARN: Context lines and records need every line in order, ignoring --jobs and --mmap.")
+                self.jobs, self.buffer_finder = 1, None
+        
+        # --count and --group-histogram only ever hold counts, never the matching lines. See aggregate.
+        self.count = arguments.count
+        self.group_histogram = arguments.group_histogram
+        self.json = arguments.json
+        if self.count or self.group_histogram:
+            if self.count and self.group_histogram:
+                raise Exception("FATAL: Pick one of --count or --group-histogram.")
+            if self.in_place or self.follow:
+                raise Exception("FATAL: --count and --group-histogram need input that ends, and don't rewrite files. Drop --in-place and --follow.")
+            if self.group_histogram and not self.pipeline.searches:
+                raise Exception("FATAL: --group-histogram counts what search patterns match, it needs a pattern without a substitute.")
+        elif self.json:
+            warn("WARN: --json is only for --count and --group-histogram output, ignoring it.")
+        
+        # --table reads delimited files with pandas a chunk of rows at a time, and runs the rules down whole
+        # columns at once instead of line by line. See table_chunks.
+        self.table = arguments.table
+        self.parquet = arguments.parquet
+        if self.table:
+            if not self.files:
+                raise Exception("FATAL: --table reads delimited files, use -f.")
+            if self.in_place or self.follow or self.count or self.group_histogram or self.record_start is not None:
+                raise Exception("FATAL: --table can't be used with --in-place, --follow, --count, --group-histogram or --record-start.")
+            if self.before or self.after or self.buffer_finder is not None or self.jobs > 1 or self.line_numbers:
+                warn("WARN: --table works on whole columns, ignoring -A/-B/-C, --mmap, --jobs and -l.")
+            # A real tab is awkward to type in a shell, so a literal backslash t is taken to mean one.
+            delimiter = '\t' if arguments.delimiter == '\\t' else arguments.delimiter
+            if len(delimiter) != 1:
+                raise Exception(f"FATAL: --delimiter has to be a single character, not `{arguments.delimiter}`. Use '\\t' for tabs.")
+            self.delimiter = delimiter
+            self.columns = arguments.columns
+            _pandas() # Missing packages are better found out now than after the output's been started.
+            if self.parquet:
+                _pyarrow()
+        elif self.parquet:
+            raise Exception("FATAL: --parquet is an output for --table, add --table.")
             
         
-    def infer(self):
+    def infer(self, output=None):
         """
         Does the actual regex work. The usecases are as follows:
         * Pattern with No Group, No Subsitute
@@ -75,32 +967,903 @@ class Pysed(object):
             Returns ALL the lines from the input, including those WITHOUT MATCHES. Every Match
             is replaced with the subsitution provided. This is intended to be used for data cleaning,
             not searching.
+        
+        Results are written as they are produced (see stream), so memory stays flat regardless of the
+        input size and the first matches show up immediately. Output goes to stdout unless another
+        writable text stream is passed in. If whoever is reading the output goes away early (piping
+        into head), the run just stops quietly.
+        
+        With --compress the output is compressed as it's written. Without an --encoding, output is raw bytes.
+        Both need a binary buffer underneath the stream passed in (stdout and regular files have one), 
+        or a binary stream to begin with.
+        """
+        if self.in_place:
+            self.edit_in_place()
+            return 0
+        if self.parquet:
+            self._write_parquet()
+            return 0
+        if output is None:
+            output = sys.stdout
+        if (self.binary or self.compress) and isinstance(output, io.TextIOBase):
+            if not hasattr(output, 'buffer'):
+                raise Exception("FATAL: Bytes or --compress output needs a stream with a binary buffer, like stdout or a file.")
+            output.flush()
+            output = output.buffer
+        target = output
+        if self.compress:
+            output = compressed_writer(output, self.compress)
+            if not self.binary:
+                output = io.TextIOWrapper(output, encoding=self.encoding, errors=self.errors)
+        write, newline = output.write, self.newline
+        # While following, whatever has been written goes out every time the file goes quiet, rather than
+        # sitting in a buffer until there's a buffer's worth.
+        def on_idle():
+            output.flush()
+            target.flush()
+        try:
+            if self.table:
+                self._write_table(output)
+            else:
+                for result in self.stream(on_idle):
+                    write(result)
+                    write(newline)
+            if output is not target:
+                output.close()
+            target.flush()
+        except BrokenPipeError:
+            # The reader hung up. Point stdout at devnull so the interpreter's final flush doesn't 
+            # raise a second time on the way out.
+            if target in (sys.stdout, getattr(sys.stdout, 'buffer', None)):
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+        return 0
+    
+    @classmethod
+    def from_argv(cls, argv, cwd=None, server=False):
+        """
+        Builds a Pysed from a list of command line arguments, ie ['-p', 'WARNING', '-f', 'app.log']. Bad 
+        arguments raise instead of exiting the interpreter like argparse normally would. With cwd, relative
+        paths given to the arguments that take them are taken from there (see resolve_paths). A server job
+        giving any of the SERVER_REFUSED arguments raises.
+        """
+        try:
+            arguments = parser.parse_args(argv)
+        except SystemExit:
+            raise Exception(f"FATAL: Could not parse arguments {argv}.")
+        refused = [flag for name, flag in SERVER_REFUSED.items() if server and getattr(arguments, name)]
+        if refused:
+            raise Exception(f"FATAL: The pysed server doesn't take {', '.join(refused)}, run pysed.py directly for those.")
+        if cwd is not None:
+            arguments = resolve_paths(arguments, cwd)
+        return cls(arguments)
+    
+    def edit_in_place(self):
+        """
+        The --in-place version of infer, sed -i style. Every file gets it's substitutions written back to it
+        instead of stdout (see _edit_in_place). Files are edited in parallel, on --jobs processes when set
+        since substitution is CPU bound, otherwise on --workers threads. Returns a dictionary of path to the
+        number of substitutions made in it, files with 0 were left alone entirely.
+        """
+        if len(self.files) == 1:
+            return {self.files[0]: self._edit_in_place(self.files[0])}
+        if self.jobs > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self,))
+            edit = _edit_worker
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+            edit = self._edit_in_place
+        with pool:
+            return dict(zip(self.files, pool.map(edit, self.files)))
+    
+    def _edit_in_place(self, path):
         """
-        return_lines = []
+        Rewrites the file at path with the substitute rules applied. Lines are streamed into a temporary file
+        in the same directory (so the final rename can't cross filesystems), which is fsync'd and renamed
+        over the original in one atomic step, keeping the original's permissions and compression. Readers 
+        see either the old file or the new one, never half of one. 
+        
+        Lines are never stripped here, even with --strip: whitespace and line endings are kept as they were,
+        only the matches change. Nothing is written until the first line that changes: a file with no
+        matches anywhere is only ever read, no temporary file is made and the original is never touched. 
+        When a change does turn up, the lines before it are copied into the temporary file from a second 
+        read of the file (raw bytes when there's no --encoding) and the rest carries on from where it was. 
+        Returns the number of substitutions made.
+        """
+        substitute = self.pipeline.substitute
+        kind = detect_compression(path)
+        line_ending = b'\r\n' if self.binary else '\r\n'
+        with open_input(path, self.encoding, self.errors, newline='') as input_file:
+            unchanged, prefix_size = 0, 0
+            for line in input_file:
+                body = line.rstrip(line_ending)
+                new_body, substitutions = substitute(body)
+                if substitutions:
+                    break
+                unchanged += 1
+                prefix_size += len(line)
+            else:
+                return 0
+            
+            directory = os.path.dirname(os.path.abspath(path))
+            handle, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.pysed')
+            try:
+                with open(handle, 'wb') as temp_file:
+                    output = compressed_writer(temp_file, kind) if kind else temp_file
+                    if not self.binary:
+                        output = io.TextIOWrapper(output, encoding=self.encoding, errors=self.errors, newline='')
+                    write = output.write
+                    with open_input(path, self.encoding, self.errors, newline='') as prefix_file:
+                        if self.binary:
+                            while prefix_size:
+                                block = prefix_file.read(min(prefix_size, READ_BUFFER_SIZE))
+                                write(block)
+                                prefix_size -= len(block)
+                        else:
+                            for _, prefix_line in zip(range(unchanged), prefix_file):
+                                write(prefix_line)
+                    write(new_body + line[len(body):])
+                    for line in input_file:
+                        body = line.rstrip(line_ending)
+                        new_body, count = substitute(body)
+                        if count:
+                            substitutions += count
+                            write(new_body + line[len(body):])
+                        else:
+                            write(line)
+                    output.flush()
+                    if not self.binary:
+                        output = output.detach() # Closing the text layer would close temp_file under it.
+                    if output is not temp_file:
+                        output.close() # Finishes the compressed stream, temp_file itself stays open for the fsync.
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                shutil.copymode(path, temp_path)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        # The rename itself only survives a crash once the directory is synced too.
+        directory_handle = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_handle)
+        finally:
+            os.close(directory_handle)
+        return substitutions
+    
+    def stream(self, on_idle=None):
+        """
+        Generator that does the work of infer one line at a time, yielding each output line (without a
+        trailing newline) as soon as it's known. The input file is read lazily, nothing but the current
+        line is ever held in memory. 
+        
+        Every pattern (-p/-s and anything from a -r rules file) goes through the one RulePipeline, see
+        there for how several rules combine. When there are substitute rules, lines come out rewritten, 
+        otherwise it's the usual search output described in infer.
+        
+        With --jobs, big files are split up and matched across processes (see _parallel_stream), the
+        output is the same either way. Several files are read concurrently, see _multi_stream.
+        
+        With --count or --group-histogram, the output is the report from aggregate instead of lines.
+        
+        With --follow the generator never finishes on it's own, it waits at the end of the file for more to
+        be written (see _follow_lines). on_idle is called each time it's caught up and about to wait.
+        """
+        if self.count or self.group_histogram:
+            return self._report()
         if hasattr(self, 'text'):
-            input_lines = [self.text]
-            line_joiner = '\n'
+            return self._matches([(1, self.text)])
+        if self.follow:
+            return self._matches(self._follow_lines(self.files[0], on_idle))
+        if len(self.files) == 1 and not self.with_filename:
+            return self._file_stream(self.files[0])
+        return self._multi_stream()
+    
+    def aggregate(self):
+        """
+        Runs the patterns over the input keeping nothing but counts, returned as a collections.Counter:
+        * --count: the number of lines that would have been output (matching lines, or with only substitute
+          rules the lines that got changed), keyed by file path. Files with no matches are there with a 0.
+          Text from the command line is keyed by '-'.
+        * --group-histogram: how many times each value was matched, over every file together. The value is 
+          what the search would have output, the groups joined together, or the whole match when the 
+          pattern has none.
+        Files are counted on --workers threads, big files are split across --jobs processes the same way
+        stream does it. Each chunk or file counts on it's own and the Counters are added together, so nothing
+        but the counts ever crosses between them.
+        """
+        if hasattr(self, 'text'):
+            return self._tally([(1, self.text)], '-')
+        counts = collections.Counter()
+        if self.workers == 1 or self.jobs > 1 or len(self.files) == 1:
+            for path in self.files:
+                counts.update(self._file_tally(path))
         else:
-            input_lines = open(self.file).readlines()
-            line_joiner = '\n'
-        
-        for line, line_no in zip(input_lines, range(1, len(input_lines)+1)):
-            if hasattr(self, 'substitute'):
-                return_lines.append(re.sub(self.pattern, self.substitute, line.strip()))
-                # IS running on all lines
-                # should only run if sub works
-                # fix later
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                for file_counts in pool.map(self._file_tally, self.files):
+                    counts.update(file_counts)
+        return counts
+    
+    def _file_tally(self, path):
+        """aggregate for a single file, split across --jobs processes when it's big enough to bother (see _file_stream)."""
+        if self.jobs > 1 and self.buffer_finder is None and os.path.getsize(path) > CHUNK_SIZE and not detect_compression(path):
+            counts = collections.Counter()
+            starts, ends = zip(*chunk_ranges(path, CHUNK_SIZE))
+            with concurrent.futures.ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self,)) as pool:
+                for chunk_counts in pool.map(_tally_worker, [path] * len(starts), starts, ends):
+                    counts.update(chunk_counts)
+            return counts
+        return self._tally(self._input_lines(path), path)
+    
+    def _tally(self, numbered_lines, name):
+        """The counting version of _matches, see aggregate. name is what --count files the lines under."""
+        search = self.pipeline.search if self.pipeline.searches else None
+        substitute = self.pipeline.substitute if self.pipeline.substitutions else None
+        body = self._body
+        empty = self.newline[:0]
+        histogram = self.group_histogram
+        if self.record_start is not None:
+            numbered_lines = self._records(numbered_lines)
+        counts = collections.Counter()
+        matched = 0
+        for line_no, line in numbered_lines:
+            if search is not None:
+                match = search(line)
+                if match is None:
+                    continue
+            elif not substitute(body(line))[1]:
+                continue
+            if histogram:
+                counts[empty.join(match.groups(empty)) if match.re.groups else match.group()] += 1
             else:
-                match = re.search(self.pattern, line)
-                if match:
-                    if match.groups():
-                        return_lines.append(''.join(match.groups()))
-                    else:
-                        if self.line_numbers: return_lines.append(f'{line_no}: {line.strip()}')
-                        else: return_lines.append(line.strip())
-        if return_lines: 
-            print(line_joiner.join(return_lines))
-        return 0
+                matched += 1
+        if not histogram:
+            counts[name] = matched
+        return counts
+    
+    def _report(self):
+        """
+        Yields the output for --count and --group-histogram, from aggregate. 
+        * --count prints the count alone for one input, or 'path:count' per file (and a 'total') for several, 
+          or when --with-filename is set. 
+        * --group-histogram prints 'count value' per value, most common first, `sort | uniq -c | sort -rn` style.
+        With --json it's one JSON object instead: {"total": n, "files": {path: count}} for --count, 
+        {"total": n, "groups": {value: count}} for --group-histogram. 
+        """
+        counts = self.aggregate()
+        total = sum(counts.values())
+        encode = os.fsencode if self.binary else str
+        if self.json:
+            if self.group_histogram:
+                report = {'total': total, 'groups': {os.fsdecode(value): count for value, count in counts.most_common()}}
+            else:
+                report = {'total': total, 'files': counts}
+            yield encode(json.dumps(report))
+        elif self.group_histogram:
+            for value, count in counts.most_common():
+                yield encode(f'{count:>7} ') + value
+        elif len(counts) == 1 and not self.with_filename:
+            yield encode(str(total))
+        else:
+            for path, count in counts.items():
+                yield encode(f'{path}:{count}')
+            if len(counts) > 1:
+                yield encode(f'total:{total}')
+    
+    def table_chunks(self):
+        """
+        The --table version of stream, for delimited files (CSV by default, see --delimiter) with a header 
+        row. Files are read TABLE_CHUNK_ROWS rows at a time into pandas DataFrames, and each chunk is yielded
+        once the rules have been run over it. Rules apply to the --columns given, or every column:
+        * Search rules filter rows. A row is kept if ANY search rule matches ANY of the columns.
+        * Substitute rules then rewrite those columns of the kept rows, in order.
+        * With only search rules, a rule with groups outputs it's groups instead of the row, one column per
+          group per searched column, named 'column.group' (the group's name, or it's number).
+        Same as RulePipeline, just down a column at a time with Series.str. Values are all kept as strings, 
+        nothing is converted to numbers or dates, so what's written back out is what was read.
+        With --with-filename each row leads with a 'file' column.
+        
+        Every file has to have the same header, in the same order, as the first: the output only gets one 
+        header (or one Parquet schema), so that's checked up front before any rows are read (see _table_header).
+        """
+        pandas = _pandas()
+        if len(self.files) > 1:
+            headers = [(path, self._table_header(pandas, path)) for path in self.files]
+            headers = [(path, header) for path, header in headers if header is not None]
+            for path, header in headers[1:]:
+                if header != headers[0][1]:
+                    raise Exception(f"FATAL: {path} has columns {', '.join(header)}, not the {', '.join(headers[0][1])} "
+                                    f"of {headers[0][0]}. Tables read together need the same header.")
+        for path in self.files:
+            with open_input(path, self.encoding, self.errors, newline='') as input_file:
+                try:
+                    chunks = pandas.read_csv(input_file, sep=self.delimiter, dtype=object, keep_default_na=False, chunksize=TABLE_CHUNK_ROWS)
+                except pandas.errors.EmptyDataError:
+                    continue
+                for frame in chunks:
+                    frame = self._table_chunk(pandas, frame, path)
+                    if self.with_filename:
+                        frame.insert(0, 'file', path)
+                    yield frame
+    
+    def _table_header(self, pandas, path):
+        """The column names of the file at path as a list, read without reading any rows. None for an empty file."""
+        with open_input(path, self.encoding, self.errors, newline='') as input_file:
+            try:
+                return [str(column) for column in pandas.read_csv(input_file, sep=self.delimiter, dtype=object, nrows=0).columns]
+            except pandas.errors.EmptyDataError:
+                return None
+    
+    def _table_chunk(self, pandas, frame, path):
+        """The work behind table_chunks for one chunk of rows."""
+        columns = self.columns or list(frame.columns)
+        missing = [column for column in columns if column not in frame.columns]
+        if missing:
+            raise Exception(f"FATAL: {path} has no column(s) {', '.join(missing)}. It has {', '.join(map(str, frame.columns))}.")
+        searches = [rule for rule in self.pipeline.rules if rule.substitute is None]
+        substitutions = [rule for rule in self.pipeline.rules if rule.substitute is not None]
+        
+        if searches:
+            keep = pandas.Series(False, index=frame.index)
+            for rule in searches:
+                for column in columns:
+                    keep |= self._table_contains(rule, frame[column])
+            frame = frame[keep]
+        if substitutions:
+            frame = frame.copy()
+            for rule in substitutions:
+                for column in columns:
+                    frame[column] = self._table_replace(rule, frame[column])
+            return frame
+        extracts = [rule for rule in searches if rule.regex.groups]
+        if not extracts:
+            return frame.copy()
+        groups = []
+        for rule in extracts:
+            names = {index: name for name, index in rule.regex.groupindex.items()}
+            for column in columns:
+                extracted = frame[column].str.extract(rule.regex, expand=True)
+                extracted.columns = [f'{column}.{names.get(index, index)}' for index in range(1, rule.regex.groups + 1)]
+                groups.append(extracted)
+        # Same as the line loop, a group that didn't take part in the match comes out empty.
+        return pandas.concat(groups, axis=1).fillna('')
+    
+    def _table_contains(self, rule, column):
+        """Series.str.contains for one rule, plain text rules skip the regex engine the same way PysedRule does."""
+        exact = exact_literal(rule.pattern, rule.flags) if isinstance(rule.pattern, str) else None
+        if exact is not None:
+            text, anchored = exact
+            return column.str.startswith(text) if anchored else column.str.contains(text, regex=False)
+        with warnings.catch_warnings(): # pandas warns about groups in a pattern used only to filter.
+            warnings.simplefilter('ignore', UserWarning)
+            return column.str.contains(rule.regex, na=False)
+    
+    def _table_replace(self, rule, column):
+        """Series.str.replace for one substitute rule, plain text and no backreferences skips the regex engine."""
+        exact = exact_literal(rule.pattern, rule.flags) if isinstance(rule.pattern, str) else None
+        if exact is not None and not exact[1] and '\\' not in rule.substitute:
+            return column.str.replace(exact[0], rule.substitute, regex=False)
+        return column.str.replace(rule.regex, rule.substitute, regex=True)
+    
+    def _write_table(self, output):
+        """Writes table_chunks to output as delimited text, with the header once at the top."""
+        header = True
+        for frame in self.table_chunks():
+            frame.to_csv(output, sep=self.delimiter, index=False, header=header, lineterminator='\n')
+            header = False
+    
+    def _write_parquet(self):
+        """
+        Writes table_chunks to the --parquet file, a row group per chunk. Every column is a string column,
+        so the schema comes from the first chunk's column names even if no rows in it were kept.
+        """
+        pyarrow = _pyarrow()
+        writer = None
+        try:
+            for frame in self.table_chunks():
+                if writer is None:
+                    schema = pyarrow.schema([(str(column), pyarrow.string()) for column in frame.columns])
+                    writer = pyarrow.parquet.ParquetWriter(self.parquet, schema)
+                frame.columns = [str(column) for column in frame.columns]
+                writer.write_table(pyarrow.Table.from_pandas(frame, schema=schema, preserve_index=False))
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    def _file_stream(self, path):
+        """stream for a single file. Compressed files can't be cut into byte ranges, they always get the line loop."""
+        if self.jobs > 1 and self.buffer_finder is None and os.path.getsize(path) > CHUNK_SIZE and not detect_compression(path):
+            return self._parallel_stream(path)
+        return self._matches(self._input_lines(path))
+    
+    def _multi_stream(self):
+        """
+        stream over every file given, in the order expand_paths put them in, each output line prefixed with
+        'path:' when --with-filename is set. Up to --workers files are read and matched at once on a thread
+        pool, overlapping the disk reads. Output still comes out one whole file at a time in a fixed order:
+        each file's results are passed along a bounded queue (see _queue_file) and the file at the head of
+        the line is written out as it's results arrive. Files further back read ahead until their queue
+        fills, then wait, so memory stays flat no matter how big the files are. No more than a couple files
+        per worker are in flight. With --jobs the files go one after the other instead, each one getting the
+        whole process pool.
+        """
+        if self.with_filename:
+            prefix = (lambda path: os.fsencode(path) + b':') if self.binary else (lambda path: f'{path}:')
+        else:
+            prefix = (lambda path: self.newline[:0])
+        if self.workers == 1 or self.jobs > 1:
+            for path in self.files:
+                name = prefix(path)
+                for result in self._file_stream(path):
+                    yield name + result
+            return
+        
+        def drain(name, results):
+            while True:
+                batch = results.get()
+                if batch is None:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                for result in batch:
+                    yield name + result
+        
+        window = collections.deque()
+        stopped = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                for path in self.files:
+                    results = queue.Queue(RESULT_BATCHES)
+                    window.append((prefix(path), results, pool.submit(self._queue_file, path, results, stopped)))
+                    if len(window) < self.workers * 2:
+                        continue
+                    name, results, future = window.popleft()
+                    yield from drain(name, results)
+                while window:
+                    name, results, future = window.popleft()
+                    yield from drain(name, results)
+            finally: # Stopped early, let the readers still going give up instead of waiting on a full queue.
+                stopped.set()
+                for name, results, future in window:
+                    future.cancel()
+    
+    def _queue_file(self, path, results, stopped):
+        """
+        Runs on _multi_stream's thread pool. Puts a file's output on results in RESULT_BATCH_SIZE line 
+        batches, then None when the file is done, or the exception if reading it failed. Gives up as soon
+        as stopped is set. The pool runs files in the order they were given, so the file being written out 
+        always has a thread, however many files behind it are stuck waiting.
+        """
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        batch = []
+        try:
+            for result in self._file_stream(path):
+                batch.append(result)
+                if len(batch) == RESULT_BATCH_SIZE:
+                    if not put(batch):
+                        return
+                    batch = []
+        except BaseException as e:
+            put(e)
+            return
+        if not batch or put(batch):
+            put(None)
+    
+    def _matches(self, numbered_lines, number_line=None):
+        """
+        The per line work behind stream. Takes (line number, line) pairs, returns a generator of output lines. 
+        number_line is what builds a line numbered output, by default 'line_no: line'. Lines are bytes or
+        text depending on --encoding, the output is the same type as the input.
+        
+        Lines keep everything but their newline unless --strip was asked for. Searching looks at the line 
+        as read, substitution works on the line without it's newline so a pattern can't eat it.
+        
+        With --record-start, lines are grouped into records first (see _records) and everything here
+        works on whole records instead. With -A/-B/-C it's _context_matches that does the searching.
+        """
+        if self.record_start is not None:
+            numbered_lines = self._records(numbered_lines)
+        if self.before or self.after:
+            return self._context_matches(numbered_lines, number_line or self._number_line)
+        return self._line_matches(numbered_lines, number_line)
+    
+    def _line_matches(self, numbered_lines, number_line=None):
+        """The plain line loop behind _matches."""
+        search = self.pipeline.search if self.pipeline.searches else None
+        substitute = self.pipeline.substitute if self.pipeline.substitutions else None
+        line_numbers = self.line_numbers
+        number_line = number_line or self._number_line
+        body = self._body
+        empty = self.newline[:0]
+        for line_no, line in numbered_lines:
+            if search is not None:
+                match = search(line)
+                if match is None:
+                    continue
+            if substitute is not None:
+                # Single pass: subn both finds and replaces, lines without a match go out untouched.
+                yield substitute(body(line))[0]
+            elif match.re.groups:
+                yield empty.join(match.groups(empty))
+            elif line_numbers:
+                yield number_line(line_no, body(line))
+            else:
+                yield body(line)
+    
+    def _context_matches(self, numbered_lines, number_line):
+        """
+        _matches for -A/-B/-C, grep style. Matching lines come out like they would without context, and 
+        around each one are the lines before and after it, numbered 'line_no- line' when numbering so they 
+        can be told apart from the matches. Groups of lines that aren't next to each other are split up by 
+        a '--' line. 
+        
+        Only the last --before-context lines are ever held, in a deque that drops the oldest line as each
+        new one comes in, so memory doesn't grow with the file no matter how far apart the matches are.
+        """
+        search = self.pipeline.search
+        substitute = self.pipeline.substitute if self.pipeline.substitutions else None
+        line_numbers = self.line_numbers
+        body = self._body
+        empty = self.newline[:0]
+        separator = b'--' if self.binary else '--'
+        number_context = self._number_context
+        before = collections.deque(maxlen=self.before)
+        after = 0
+        last = None # Position of the last line written, to know when a separator is needed.
+        for position, (line_no, line) in enumerate(numbered_lines):
+            match = search(line)
+            if match is None:
+                if after:
+                    after -= 1
+                    last = position
+                    yield number_context(line_no, body(line)) if line_numbers else body(line)
+                elif self.before:
+                    before.append((position, line_no, line))
+                continue
+            first = before[0][0] if before else position
+            if last is not None and first > last + 1:
+                yield separator
+            for _, context_no, context_line in before:
+                yield number_context(context_no, body(context_line)) if line_numbers else body(context_line)
+            before.clear()
+            if substitute is not None:
+                yield substitute(body(line))[0]
+            elif match.re.groups:
+                yield empty.join(match.groups(empty))
+            elif line_numbers:
+                yield number_line(line_no, body(line))
+            else:
+                yield body(line)
+            last = position
+            after = self.after
+    
+    def _records(self, numbered_lines):
+        """
+        Groups (line number, line) pairs into (first line number, record) pairs for --record-start. A record
+        starts at a line the --record-start regex finds a match in and runs until the next one, so a log
+        entry and the stack trace under it are searched as one. The record keeps the newlines between it's 
+        lines: patterns see them, . won't cross them unless (?s) is set, and ^ and $ need (?m) to work per line.
+        
+        Only the record being built is held. A record is cut off at --record-lines lines (and the rest of it
+        starts a new one), so input that never matches the start regex can't pile up in memory.
+        """
+        starts = self.record_start.search
+        limit = self.record_lines
+        empty = self.newline[:0]
+        first, lines = None, []
+        for line_no, line in numbered_lines:
+            if lines and (len(lines) >= limit or starts(line)):
+                yield first, empty.join(lines)
+                lines = []
+            if not lines:
+                first = line_no
+            lines.append(line)
+        if lines:
+            yield first, empty.join(lines)
+    
+    def _parallel_stream(self, path):
+        """
+        --jobs version of stream. The file is cut into CHUNK_SIZE byte ranges that end on a newline, and
+        a pool of processes runs _chunk_results over them. Results are written back in file order as soon 
+        as the chunk at the front is done, with only a couple chunks per worker in flight at a time so 
+        memory stays bounded. Workers number lines from the start of their chunk, the real line number is
+        added back here from the running count of lines in the chunks before it.
+        """
+        window = collections.deque()
+        chunks = chunk_ranges(path, CHUNK_SIZE)
+        line_offset = 0
+        with concurrent.futures.ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self,)) as pool:
+            try:
+                for start, end in chunks:
+                    window.append(pool.submit(_chunk_worker, path, start, end))
+                    if len(window) < self.jobs * 2:
+                        continue
+                    results, line_count = window.popleft().result()
+                    yield from renumber(results, line_offset, self._number_line)
+                    line_offset += line_count
+                while window:
+                    results, line_count = window.popleft().result()
+                    yield from renumber(results, line_offset, self._number_line)
+                    line_offset += line_count
+            finally: # Stopped early (broken pipe or the caller gave up), don't wait on work nobody wants.
+                for future in window:
+                    future.cancel()
+    
+    def _chunk_results(self, path, start, end):
+        """
+        Runs the normal per line matching over bytes start to end of the file at path. Numbered results come back as
+        (chunk line number, line) so _parallel_stream can fix them up. Returns the results and the number
+        of lines in the chunk.
+        """
+        chunk = self._chunk_input(path, start, end)
+        line_count = 0
+        def numbered_lines():
+            nonlocal line_count
+            for line_count, line in enumerate(chunk, 1):
+                yield line_count, line
+        results = list(self._matches(numbered_lines(), number_line=lambda line_no, line: (line_no, line)))
+        return results, line_count
+    
+    def _chunk_input(self, path, start, end):
+        """Reads bytes start to end of the file at path, as lines with the same decoding and newline handling open_input gives the line loop."""
+        with open(path, 'rb') as input_file:
+            input_file.seek(start)
+            data = input_file.read(end - start)
+        chunk = io.BytesIO(data)
+        if not self.binary:
+            chunk = io.TextIOWrapper(chunk, encoding=self.encoding, errors=self.errors)
+        return chunk
+    
+    def _input_lines(self, path):
+        """
+        Yields (line number, line) pairs from the file at path. Files are iterated rather than readlines()'d,
+        with a large read buffer so big logs come off disk in big chunks. Compressed files are decompressed
+        as they're read (see open_input), and can't be memory mapped.
+        """
+        if self.buffer_finder is not None and not detect_compression(path):
+            yield from self._buffer_lines(path)
+        else:
+            with open_input(path, self.encoding, self.errors) as input_file:
+                yield from enumerate(input_file, 1)
+    
+    def _follow_lines(self, path, on_idle=None):
+        """
+        _input_lines for --follow, `tail -F` style: reads to the end of the file, then waits for more instead 
+        of stopping. A line isn't yielded until it's newline has been written, so a half written line never 
+        gets matched half way.
+        
+        Handles the file being rotated out from under it (renamed away and a new file created at path), and 
+        being truncated in place (copytruncate). Either way reading starts over at the top of the new data,
+        line numbers included. Waiting is done by fswatch.Watcher, inotify where the OS has it, otherwise 
+        stat polling every FOLLOW_INTERVAL.
+        """
+        import fswatch
+        decode = None
+        if not self.binary:
+            decode = lambda line: line.decode(self.encoding, self.errors).replace('\r\n', '\n')
+        
+        input_file = open(path, 'rb', buffering=0)
+        line_no, partial = 0, b''
+        try:
+            with fswatch.Watcher([path], interval=FOLLOW_INTERVAL) as watcher:
+                while True:
+                    data = input_file.read(READ_BUFFER_SIZE)
+                    if data:
+                        lines = (partial + data).split(b'\n')
+                        partial = lines.pop()
+                        for line in lines:
+                            line_no += 1
+                            line += b'\n'
+                            yield line_no, line if decode is None else decode(line)
+                        continue
+                    # Caught up. Before sleeping, check the file at path is still the one being read.
+                    try:
+                        current = os.stat(path)
+                    except FileNotFoundError:
+                        current = None # Mid rotation, the new file isn't there yet.
+                    opened = os.fstat(input_file.fileno())
+                    if current is not None and current.st_ino != opened.st_ino:
+                        # Rotated. Finish the old file first, whatever was written to it since the last read
+                        # and a last line that never got it's newline, like tail -F does.
+                        lines = (partial + input_file.read()).split(b'\n')
+                        partial = lines.pop()
+                        for line in lines:
+                            line_no += 1
+                            line += b'\n'
+                            yield line_no, line if decode is None else decode(line)
+                        if partial:
+                            line_no += 1
+                            yield line_no, partial if decode is None else decode(partial)
+                        input_file.close()
+                        input_file = open(path, 'rb', buffering=0)
+                        line_no, partial = 0, b''
+                        continue
+                    if opened.st_size < input_file.tell():
+                        input_file.seek(0)
+                        line_no, partial = 0, b''
+                        continue
+                    if on_idle is not None:
+                        on_idle()
+                    watcher.wait(FOLLOW_INTERVAL)
+        finally:
+            input_file.close()
+    
+    def _buffer_finder(self):
+        """
+        Builds the bytes regex --mmap runs over the whole file. It only has to find CANDIDATE lines, every
+        candidate still goes through the normal line search in stream, so the output is exactly what the line
+        loop would give. What it can't do is miss a line, so:
+        * If every search rule requires some plain text (see required_literal), the finder is just that
+          text, escaped. Exact, and about the fastest thing re can look for.
+        * Otherwise a single search pattern is used as is, in MULTILINE mode so ^ and $ still mean the 
+          start and end of a line. Bytes regex are ASCII only, so with an --encoding other than ASCII the
+          pattern has to be one that can't miss anything that way (see byte_safe), no \\w, ignore case, 
+          . and so on. Without an encoding the line loop is bytes too and they behave the same.
+        Returns None when neither works (several patterns without literals, a pattern leaning on \\A, 
+        \\Z or a lookbehind, which behave differently over a whole buffer, one using $ with an encoding,
+        see ends_line, or any pattern that can match across a line end or match nothing at all, see
+        crosses_lines), and the line loop is used.
+        """
+        encode = (lambda text: text) if self.binary else (lambda text: text.encode(self.encoding))
+        if any(crosses_lines(rule.pattern, rule.flags) for rule in self.pipeline.rules):
+            return None
+        if self.pipeline.prefilter is not None:
+            literals = sorted(self.pipeline.prefilter, key=len, reverse=True)
+            return re.compile(b'|'.join(re.escape(encode(literal)) for literal in literals))
+        if len(self.pipeline.rules) != 1:
+            return None
+        rule = self.pipeline.rules[0]
+        if not self.binary and codecs.lookup(self.encoding).name != 'ascii' and not byte_safe(rule.pattern, rule.flags):
+            return None
+        if not self.binary and ends_line(rule.pattern, rule.flags): # The line loop reads \r\n as \n.
+            return None
+        tokens = ('\\A', '\\Z', '(?<=', '(?<!')
+        if any((os.fsencode(token) if self.binary else token) in rule.pattern for token in tokens):
+            return None
+        try:
+            return re.compile(encode(rule.pattern), (rule.flags & ~re.ASCII) | re.MULTILINE)
+        except (re.error, UnicodeEncodeError):
+            return None
+    
+    def _buffer_lines(self, path):
+        """
+        The --mmap version of reading the file. The file is memory mapped and the finder regex (see
+        _buffer_finder) runs over the whole thing in C, the only lines that ever become Python strings are
+        the ones it hits. Line numbers are worked out by counting newlines between hits, also in C, and only
+        when they're actually wanted.
+        Yields (line number, line) pairs just like the line loop, only for candidate lines. 
+        """
+        with open(path, 'rb') as input_file:
+            try:
+                buffer = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty files can't be mapped, and have nothing to find anyway.
+                return
+            with buffer:
+                search, size = self.buffer_finder.search, len(buffer)
+                line_no, counted, position = 1, 0, 0
+                while position < size:
+                    match = search(buffer, position)
+                    if match is None or match.start() >= size: # Nothing after the last line is a line.
+                        break
+                    start = buffer.rfind(b'\n', 0, match.start()) + 1
+                    end = buffer.find(b'\n', match.start())
+                    end = size if end == -1 else end + 1
+                    if self.line_numbers:
+                        line_no += count_newlines(buffer, counted, start)
+                        counted = start
+                    line = buffer[start:end]
+                    if not self.binary:
+                        if line.endswith(b'\r\n'): # Text mode would have turned these into plain newlines
+                            line = line[:-2] + b'\n'
+                        line = line.decode(self.encoding, self.errors)
+                    yield line_no, line
+                    position = end
+
+class PysedRequestHandler(socketserver.StreamRequestHandler):
+    
+    """
+    Handles one job for the pysed server (see serve). The client sends a single line of JSON, 
+        {"argv": ["-p", "WARNING", "-f", "app.log"], "cwd": "/where/the/client/is"}
+    and gets the output back as lines, the connection closing when the job is done. Output is raw bytes
+    unless the job gave an --encoding, then it's UTF-8. If the job fails, the FATAL message is the last 
+    line sent. Jobs can't use the arguments in SERVER_REFUSED.
+    """
+    
+    wbufsize = READ_BUFFER_SIZE
+    
+    def handle(self):
+        output = io.TextIOWrapper(self.wfile, encoding='utf-8')
+        try:
+            request = json.loads(self.rfile.readline())
+            argv, cwd = list(request['argv']), request.get('cwd') or os.getcwd()
+            job = Pysed.from_argv(argv, cwd, server=True)
+            job.infer(output)
+        except Exception as e:
+            output.write(f'{e}\n')
+        finally:
+            try:
+                output.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            output.detach()
+
+# Arguments a server job can't use, and their flags. --follow never ends, so it would hold one of the server's
+# threads for good, and --metrics/--profile are reported by the command line, not the server.
+SERVER_REFUSED = {'follow': '--follow', 'metrics': '--metrics', 'metrics_file': '--metrics-file', 'profile': '--profile', 'serve': '--serve'}
+
+# Arguments holding paths, which resolve_paths makes absolute.
+PATH_ARGUMENTS = ('rules', 'keywords_file', 'parquet', 'metrics_file')
+
+def resolve_paths(arguments, cwd):
+    """
+    Returns a copy of parsed arguments with the paths in them (-f files and globs, and PATH_ARGUMENTS) made
+    absolute against cwd. The server has one working directory and many clients, each client's relative 
+    paths have to mean what they meant where the client is. Only values parsed for those arguments are
+    touched, however they were written (-f x, --file=x...), never a pattern or text that looks like a path.
+    """
+    resolved = vars(arguments).copy()
+    if resolved.get('file'):
+        resolved['file'] = [os.path.join(cwd, path) for path in resolved['file']]
+    for name in PATH_ARGUMENTS:
+        if resolved.get(name):
+            resolved[name] = os.path.join(cwd, resolved[name])
+    return argparse.Namespace(**resolved)
+
+def serve(socket_path):
+    """
+    Runs pysed as a long lived server on a Unix socket, so the tools calling it thousands of times don't pay
+    for starting Python and setting up argparse each time. Compiled patterns are cached (compile_pattern) 
+    for the life of the server, so repeat jobs skip compiling too. Jobs run on their own threads. See 
+    PysedRequestHandler for the protocol, request is the matching client. 
+    
+    A leftover socket file from a server that's no longer running is cleaned up, a live one is an error.
+    """
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            raise Exception(f"FATAL: A pysed server is already listening on {socket_path}.")
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    
+    # Owner only from the moment the socket exists, a chmod after bind would leave a window open.
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, PysedRequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def request(socket_path, argv, cwd=None):
+    """
+    Sends a job to a pysed server (see serve) and yields it's output lines as they arrive. argv is the same
+    list you'd give pysed.py on the command line.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps({'argv': list(argv), 'cwd': cwd or os.getcwd()}).encode() + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('r', encoding='utf-8', errors='surrogateescape') as response:
+            for line in response:
+                yield line.rstrip('\n')
 
 def unit_tests():
     """Text Matches Unit Tests"""
@@ -221,6 +1984,351 @@ def unit_tests():
     args = parser.parse_args(argv)
     Pysed(args).infer()
     print('-------------------------')
+    
+    # Several files, -f once for each, -H to tell them apart. Text after a -f is still text.
+    argv =  [
+                "--pattern", "^WARNING: OH",
+                "--file", "../../tests/regexsample.log",
+                "--file", "../../tests/sample_rules.json",
+                "--with-filename",
+                "some text",
+            ]
+    args = parser.parse_args(argv)
+    print(args.file, args.text)
+    Pysed(args).infer()
+    print('-------------------------')
+    
+    """Keywords Unit Tests"""
+    
+    # Keywords as a trie (or an automaton with pyahocorasick) give the same lines as the plain alternation, 
+    # longest keyword first when substituting. The Pysed has to pickle, it's what --jobs under spawn sends.
+    import pickle
+    print(trie_pattern(['foobar', 'foobaz', 'food']))
+    with tempfile.TemporaryDirectory() as directory:
+        keywords_path = os.path.join(directory, 'keywords.txt')
+        with open(keywords_path, 'w') as keywords_file:
+            keywords_file.write('joker\nOH\n\nOH NO\nshaggy\n')
+        for argv in (["-k", keywords_path], ["-k", keywords_path, "-s", "<\\g<0>>"]):
+            output = io.BytesIO()
+            keywords = Pysed.from_argv(argv + ["-f", "../../tests/regexsample.log"])
+            pickle.loads(pickle.dumps(keywords)).infer(output)
+            print(output.getvalue())
+        output = io.BytesIO()
+        Pysed.from_argv(["-p", "OH NO|OH|joker|shaggy", "-f", "../../tests/regexsample.log"]).infer(output)
+        print(output.getvalue())
+    print('-------------------------')
+    
+    """Jobs Unit Tests"""
+    
+    # A file cut into many small chunks over 2 processes gives the same output, line numbers included, as
+    # reading it in one go.
+    global CHUNK_SIZE
+    chunk_size, CHUNK_SIZE = CHUNK_SIZE, 1024
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.log')
+            with open(path, 'wb') as jobs_file:
+                for copy in range(200):
+                    jobs_file.write(b'INFO: copy %d\nWARNING: copy %d\n' % (copy, copy))
+            for argv in (["-p", "^WARNING", "-l"], ["-p", "^WARNING: copy (1\\d*)$"], ["-p", "WARNING", "-s", "WARN"], ["-p", "WARNING", "--count"]):
+                outputs = []
+                for jobs in ("1", "2"):
+                    output = io.BytesIO()
+                    Pysed.from_argv(argv + ["-f", path, "--jobs", jobs]).infer(output)
+                    outputs.append(output.getvalue())
+                print(outputs[0] == outputs[1], len(outputs[0].splitlines()))
+            # UTF-16 can't be cut at \n bytes, --jobs and --mmap read it line by line and --follow refuses it.
+            utf16 = os.path.join(directory, 'utf16.log')
+            with open(utf16, 'w', encoding='utf-16') as utf16_file:
+                for copy in range(200):
+                    utf16_file.write(f'INFO: copy {copy}\nWARNING: copy {copy}\n')
+            outputs = []
+            for extra in ([], ["--jobs", "2"], ["--mmap"]):
+                output = io.StringIO()
+                Pysed.from_argv(["-p", "^WARNING", "-l", "-e", "utf-16", "-f", utf16] + extra).infer(output)
+                outputs.append(output.getvalue())
+            print(outputs[0] == outputs[1] == outputs[2], len(outputs[0].splitlines()))
+            try:
+                Pysed.from_argv(["-p", "^WARNING", "-e", "utf-16", "--follow", "-f", utf16])
+            except Exception as e:
+                print(e)
+    finally:
+        CHUNK_SIZE = chunk_size
+    print('-------------------------')
+    
+    """Compression Unit Tests"""
+    
+    # gzip, bz2 and xz copies of the sample, found by their magic bytes rather than their names, search the
+    # same as the plain file. --compress writes output that decompresses back to the plain output.
+    with open('../../tests/regexsample.log', 'rb') as sample_file:
+        sample = sample_file.read()
+    with tempfile.TemporaryDirectory() as directory:
+        for kind, compress in (('gz', gzip.compress), ('bz2', bz2.compress), ('xz', lzma.compress)):
+            path = os.path.join(directory, f'{kind}.log')
+            with open(path, 'wb') as compressed_file:
+                compressed_file.write(compress(sample))
+            output = io.StringIO()
+            Pysed.from_argv(["-p", "^WARNING: (.*)", "-e", "utf-8", "-f", path]).infer(output)
+            print(detect_compression(path), output.getvalue().split('\n'))
+        output = io.BytesIO()
+        Pysed.from_argv(["-p", "^WARNING", "-f", "../../tests/regexsample.log", "--compress", "gz"]).infer(output)
+        print(gzip.decompress(output.getvalue()))
+    print('-------------------------')
+    
+    """Follow Unit Tests"""
+    
+    # Each time --follow catches up the log moves on a step: more lines and a last one with no newline, 
+    # then rotated to a new file, then truncated in place. Every WARNING line comes out exactly once.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'follow.log')
+        with open(path, 'w') as log_file:
+            log_file.write('WARNING: a\nINFO: x\n')
+        def rotate():
+            with open(path, 'a') as log_file:
+                log_file.write('WARNING: b\nWARNING: c')
+            os.rename(path, path + '.1')
+            with open(path, 'w') as log_file:
+                log_file.write('INFO: y\nWARNING: d\n')
+        def truncate():
+            with open(path, 'w') as log_file:
+                log_file.write('WARNING: e\n')
+        steps = [rotate, truncate]
+        def on_idle():
+            if steps:
+                steps.pop(0)()
+        lines = []
+        follower = Pysed.from_argv(['-p', '^WARNING', '-f', path, '--follow', '-e', 'utf-8', '-l']).stream(on_idle)
+        for line in follower:
+            lines.append(line)
+            if len(lines) == 5:
+                follower.close()
+                break
+        print(lines)
+    print('-------------------------')
+    
+    """Server Unit Tests"""
+    
+    # A server in it's own process, owner only socket, relative paths taken from the client's cwd however
+    # they were written, and a failed job answered with it's FATAL message. Ctrl-C cleans the socket up.
+    import signal
+    import subprocess
+    import time
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, 'pysed.sock')
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', socket_path])
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+            print(oct(os.stat(socket_path).st_mode & 0o777))
+            tests = os.path.abspath('../../tests')
+            print(list(request(socket_path, ['-p', '^WARNING', '-f', 'regexsample.log'], tests)))
+            print(list(request(socket_path, ['-p', '^WARNING: (.*)', '--file=regexsample.log', '-e', 'utf-8'], tests)))
+            print(list(request(socket_path, ['-p', '^WARNING', '-f', 'missing.log'], tests)))
+            print(list(request(socket_path, ['-p', '^WARNING', '-f', 'regexsample.log', '--follow', '--metrics', 'json'], tests)))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+        print(os.path.exists(socket_path))
+    print('-------------------------')
+    
+    """In Place Unit Tests"""
+    
+    # Edits copies, never the sample itself. Line endings, permissions and compression all survive, and a
+    # file with nothing to change isn't touched at all (same inode).
+    with open('../../tests/regexsample.log', 'rb') as sample_file:
+        sample = sample_file.read()
+    with tempfile.TemporaryDirectory() as directory:
+        crlf, packed, missed, text = (os.path.join(directory, name) for name in ('crlf.log', 'packed.log.gz', 'missed.log', 'text.log'))
+        with open(crlf, 'wb') as crlf_file:
+            crlf_file.write(sample.replace(b'\n', b'\r\n'))
+        os.chmod(crlf, 0o640)
+        with gzip.open(packed, 'wb') as packed_file:
+            packed_file.write(sample)
+        shutil.copyfile('../../tests/regexsample.log', missed)
+        with open(text, 'wb') as text_file:
+            text_file.write('INFO: ärger\r\nINFO: ok\r\n'.encode('utf-8'))
+        inode = os.stat(missed).st_ino
+        print(list(Pysed.from_argv(['-p', '^ERROR', '-s', 'E', '-i', '-f', missed]).edit_in_place().values()), os.stat(missed).st_ino == inode)
+        print(list(Pysed.from_argv(['-p', '^WARNING', '-s', 'WARN', '-i', '-f', crlf, '-f', packed]).edit_in_place().values()))
+        with open(crlf, 'rb') as crlf_file:
+            print(crlf_file.read().split(b'\r\n'), oct(os.stat(crlf).st_mode & 0o777))
+        with gzip.open(packed, 'rb') as packed_file:
+            print(packed_file.read() == sample.replace(b'WARNING', b'WARN'))
+        print(list(Pysed.from_argv(['-p', 'ärger', '-s', 'anger', '-e', 'utf-8', '-i', '-f', text]).edit_in_place().values()))
+        with open(text, 'rb') as text_file:
+            print(text_file.read())
+    print('-------------------------')
+    
+    """Whole Buffer Unit Tests"""
+    
+    # --mmap finds the same lines as the line loop, $ included, in a file with \r\n line endings.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'crlf.log')
+        with open(path, 'wb') as crlf_file:
+            crlf_file.write(b'a1\r\nb\r\nc2\r\n')
+        for argv in (["--pattern", "[0-9]$", "--file", path, "--encoding", "utf-8"],
+                     ["--pattern", "[0-9]$", "--file", path, "--encoding", "utf-8", "--mmap"]):
+            output = io.StringIO()
+            Pysed(parser.parse_args(argv)).infer(output)
+            print(output.getvalue().split())
+    print('-------------------------')
+
+    # Patterns that can match nothing, or a line end, give the line loop's output too. No phantom line
+    # after the last one for ^$, `a` for \s$, and the \r\n file still matches a literal \n.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ends.log')
+        with open(path, 'wb') as ends_file:
+            ends_file.write(b'a\nb \n')
+        crlf = os.path.join(directory, 'crlf.log')
+        with open(crlf, 'wb') as crlf_file:
+            crlf_file.write(b'a1\r\nb\r\n')
+        for argv in (["-p", "^$", "-l", "-f", path], ["-p", r"\s$", "-f", path], ["-p", r"[^x]b", "-f", path],
+                     ["-p", "(?s)a.", "-f", path], ["-p", r"1\n", "-e", "utf-8", "-f", crlf]):
+            outputs = []
+            for extra in ([], ["--mmap"]):
+                output = io.StringIO() if '-e' in argv else io.BytesIO()
+                Pysed(parser.parse_args(argv + extra)).infer(output)
+                outputs.append(output.getvalue())
+            print(argv[1], outputs[0] == outputs[1], outputs[1])
+    print('-------------------------')
+
+    """Rules File Unit Tests"""
+    
+    # Search rules filter (WARNING or joker lines), substitute rules then rewrite what's left.
+    argv =  [
+                "--rules", "../../tests/sample_rules.json",
+                "--file", "../../tests/regexsample.log"
+            ]
+    args = parser.parse_args(argv)
+    Pysed(args).infer()
+    print('-------------------------')
+
+    # Inline flags stay with their own rule, a.c doesn't pick up (?i) from the rule next to it.
+    pipeline = RulePipeline([PysedRule('a.c'), PysedRule('(?i)X.Z')])
+    print(pipeline.search('ABC') is None, pipeline.search('xyz') is not None, pipeline.search('abc') is not None)
+    print('-------------------------')
+
+    """Context Unit Tests"""
+    
+    # WARNING lines with the line on either side of them.
+    argv =  [
+                "--pattern", "^WARNING",
+                "--file", "../../tests/regexsample.log",
+                "--linenumbers",
+                "--context", "1",
+            ]
+    args = parser.parse_args(argv)
+    Pysed(args).infer()
+    print('-------------------------')
+
+    # A log entry and the trace under it are one record: searched, numbered, counted and cut off as a whole.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'records.log')
+        with open(path, 'w') as records_file:
+            records_file.write('2020 INFO start\n2020 ERROR boom\n  at foo\n  at bar\n2020 INFO done\n')
+        for extra in (["-p", "at bar", "-l"], ["-p", "at bar", "-c"], ["-p", "(?s)ERROR.*bar", "-c"],
+                      ["-p", "at bar", "--record-lines", "2", "-l"]):
+            output = io.StringIO()
+            Pysed.from_argv(["--record-start", r"^\d{4} ", "-e", "utf-8", "-f", path] + extra).infer(output)
+            print(extra, output.getvalue().split('\n'))
+    print('-------------------------')
+    
+    """Counting Unit Tests"""
+    
+    # Counts the WARNING lines instead of printing them.
+    argv =  [
+                "--pattern", "^WARNING",
+                "--file", "../../tests/regexsample.log",
+                "--count",
+            ]
+    args = parser.parse_args(argv)
+    Pysed(args).infer()
+    print('-------------------------')
+    
+    # How often each word before a colon shows up, as JSON.
+    argv =  [
+                "--pattern", r"^(\w+):",
+                "--file", "../../tests/regexsample.log",
+                "--group-histogram",
+                "--json",
+            ]
+    args = parser.parse_args(argv)
+    Pysed(args).infer()
+    print('-------------------------')
+
+    """Table Unit Tests"""
+
+    try:
+        import pandas
+    except ImportError:
+        pandas = None
+    if pandas is None:
+        print('pandas is not installed, skipping --table')
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = os.path.join(directory, 'first.csv'), os.path.join(directory, 'second.csv')
+            tabbed, other = os.path.join(directory, 'tabbed.tsv'), os.path.join(directory, 'other.csv')
+            for path, text in ((first, 'level,message\nWARNING,disk low\nINFO,WARNING ahead\n'),
+                               (second, 'level,message\nERROR,disk gone\nWARNING,disk full\n'),
+                               (tabbed, 'level\tmessage\nWARNING\tdisk low\nINFO\tall good\n'),
+                               (other, 'host,message\nweb1,ok\n')):
+                with open(path, 'w') as table_file:
+                    table_file.write(text)
+            # Only the level column is searched, the header is written once for both files.
+            output = io.StringIO()
+            Pysed.from_argv(["-p", "WARNING", "--table", "--columns", "level", "-f", first, "-f", second]).infer(output)
+            print(output.getvalue().split('\n'))
+            # Groups come out as their own columns, substitutes rewrite every column, '\t' means a tab.
+            output = io.StringIO()
+            Pysed.from_argv(["-p", r"disk (?P<state>\w+)", "--table", "--columns", "message", "-f", first]).infer(output)
+            print(output.getvalue().split('\n'))
+            output = io.StringIO()
+            Pysed.from_argv(["-p", "disk", "-s", "drive", "--table", "--delimiter", "\\t", "-f", tabbed]).infer(output)
+            print(output.getvalue().split('\n'))
+            # Bad delimiters, missing columns and a header that doesn't match the first file's are all fatal.
+            for argv in (["-p", "WARNING", "--table", "--delimiter", "::", "-f", first],
+                         ["-p", "WARNING", "--table", "--columns", "host", "-f", first],
+                         ["-p", "WARNING", "--table", "-f", first, "-f", other]):
+                try:
+                    Pysed.from_argv(argv).infer(io.StringIO())
+                except Exception as e:
+                    print(e)
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                print('pyarrow is not installed, skipping --parquet')
+            else:
+                parquet = os.path.join(directory, 'out.parquet')
+                Pysed.from_argv(["-p", "WARNING", "--table", "--parquet", parquet, "-f", first, "-f", second]).infer()
+                print(pyarrow.parquet.read_table(parquet).to_pylist())
+    print('-------------------------')
+
+    """Instrumentation Unit Tests"""
+    
+    # Times the run while it's switched on, then prints the lines, bytes and matches it counted.
+    import instrument
+    argv =  [
+                "--pattern", "^WARNING",
+                "--file", "../../tests/regexsample.log",
+            ]
+    args = parser.parse_args(argv)
+    metrics = instrument.enable(sys.modules[__name__])
+    try:
+        Pysed(args).infer()
+    finally:
+        instrument.disable()
+    print(metrics.report()['counters'])
+    # What a --jobs worker gets mid run has to pickle, and come out as the plain pipeline.
+    import pickle
+    instrumented = Pysed(args)
+    restore = instrument._instrument_pipeline(instrumented.pipeline)
+    try:
+        print(type(pickle.loads(pickle.dumps(instrumented)).pipeline.searches[0]).__name__)
+    finally:
+        restore()
+    print('-------------------------')
 
 """
 Arguments for the Pysed class initialization. 
@@ -231,10 +2339,62 @@ Quotes are recommended around pretty much every input, given regex uses many spe
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--pattern', help="Regex Pattern to search for")
 parser.add_argument('-s', '--substitute', help="Matches will be replaced with this.")
+parser.add_argument('-r', '--rules', help="JSON (or YAML) file with a list of pattern/substitute/flags rules to run in one pass.")
+parser.add_argument('-k', '--keywords-file', help="File of plain text keywords, one per line, to search for all at once. -s replaces them.")
 parser.add_argument('text', nargs='*', help="text string to search in")
-parser.add_argument('-f', '--file', help="file to be read as the text to search in")
+parser.add_argument('-f', '--file', action='append', help="file, directory or glob to be read as the text to search in, repeat -f for more than one")
+parser.add_argument('-R', '--recursive', action='store_true', help="Search everything under directories given to -f, and let ** globs recurse.")
+parser.add_argument('-H', '--with-filename', action='store_true', help="Prefix each output line with the file it came from.")
+parser.add_argument('-w', '--workers', type=int, default=4, help="Files read and matched at the same time when searching many files.")
 parser.add_argument('-l', '--linenumbers', action='store_true', help='Prints line numbers when searching with no groups.')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Processes to split large files across. Output order is unchanged.')
+parser.add_argument('-i', '--in-place', action='store_true', help="Write substitutions back into the files instead of printing them. Untouched files aren't rewritten.")
+parser.add_argument('-z', '--compress', choices=['gz', 'bz2', 'xz', 'zst'], help="Compress the output, ie for cleaning a log with -s straight back into a .gz.")
+parser.add_argument('-e', '--encoding', help="Decode the input as text in this encoding. Without it, lines are matched and written as raw bytes.")
+parser.add_argument('--errors', default='strict', help="What to do with bytes that don't decode under --encoding: strict, replace, ignore, surrogateescape...")
+parser.add_argument('--strip', action='store_true', help="Strip whitespace from both ends of output lines instead of keeping them as they were.")
+parser.add_argument('--mmap', action='store_true', help='Search the whole file as one memory mapped buffer instead of line by line. Search only.')
+parser.add_argument('--follow', action='store_true', help="Keep reading the file as it grows, like tail -F. Survives log rotation and truncation.")
+parser.add_argument('-A', '--after-context', type=int, metavar='N', help="Print N lines after each match.")
+parser.add_argument('-B', '--before-context', type=int, metavar='N', help="Print N lines before each match.")
+parser.add_argument('-C', '--context', type=int, default=0, metavar='N', help="Print N lines before and after each match, -A and -B override it.")
+parser.add_argument('--record-start', metavar='REGEX', help="Lines matching this start a new record, the lines under it belong to it. Records are searched and printed whole.")
+parser.add_argument('--record-lines', type=int, default=1000, metavar='N', help="Most lines a --record-start record holds before it's cut off.")
+parser.add_argument('-c', '--count', action='store_true', help="Print how many lines matched (per file with several files) instead of the lines.")
+parser.add_argument('--group-histogram', action='store_true', help="Print how many times each matched group value came up, most common first, instead of the lines.")
+parser.add_argument('--json', action='store_true', help="Print --count or --group-histogram results as JSON.")
+parser.add_argument('--table', action='store_true', help="Read the files as delimited tables with pandas, running the rules down columns. See --columns.")
+parser.add_argument('--delimiter', default=',', help="Single character field separator for --table input and output, '\\t' for tabs.")
+parser.add_argument('--columns', nargs='+', metavar='COLUMN', help="Columns --table runs the rules on, every column by default.")
+parser.add_argument('--parquet', metavar='PATH', help="Write --table output to this Parquet file (needs pyarrow) instead of delimited text.")
+parser.add_argument('--metrics', choices=['json', 'prometheus'], help="Time the run's stages and patterns and print the numbers to stderr (or --metrics-file) at the end.")
+parser.add_argument('--metrics-file', metavar='PATH', help="Write --metrics here instead of stderr.")
+parser.add_argument('--profile', nargs='?', const='-', metavar='PATH', help="Run under cProfile. Prints the slowest functions to stderr, or saves the profile to PATH.")
+parser.add_argument('--serve', metavar='SOCKET', help="Run as a server on this Unix socket instead, taking jobs until stopped.")
 
-# unit_tests()
-args= parser.parse_args()
-Pysed(args).infer()
\ No newline at end of file
+if __name__ == '__main__':
+    # unit_tests()
+    args= parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+    else:
+        if args.metrics or args.profile:
+            # Only imported when asked for, instrument swaps the timed methods in over the class's own.
+            import instrument
+            if args.metrics:
+                metrics = instrument.enable(sys.modules[__name__])
+        try:
+            if args.profile:
+                instrument.profile(Pysed(args).infer, path=args.profile)
+            else:
+                Pysed(args).infer()
+        except KeyboardInterrupt: # The only way out of --follow.
+            pass
+        finally:
+            if args.metrics:
+                report = metrics.to_json(indent=2) + '\n' if args.metrics == 'json' else metrics.prometheus()
+                if args.metrics_file:
+                    with open(args.metrics_file, 'w') as metrics_file:
+                        metrics_file.write(report)
+                else:
+                    sys.stderr.write(report)
\ No newline at end of file